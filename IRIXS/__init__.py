@@ -1,3 +1,23 @@
-from .instrument_rowland import irixs
-from .instrument_spectrograph import spectrograph
-from .ub import sixc
+import importlib
+
+# the classes are imported on first use, so that `import IRIXS` and the
+# console scripts (which only need a few helpers) start quickly
+_classes = {
+    "irixs": ".instrument_rowland",
+    "spectrograph": ".instrument_spectrograph",
+    "sixc": ".ub",
+}
+
+__all__ = list(_classes)
+
+
+def __getattr__(name):
+    if name in _classes:
+        cls = getattr(importlib.import_module(_classes[name], __name__), name)
+        globals()[name] = cls
+        return cls
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
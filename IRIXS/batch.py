@@ -0,0 +1,84 @@
+""" batch processing of independent runs in worker processes
+
+Conditioning a temperature or momentum series handles runs one after
+another, loading included. run_batch spreads independent jobs (a run, or a
+group of runs stitched together) over a pool of processes:
+
+- every worker gets a copy of the instrument without loaded runs, loads
+  its runs itself and writes the same output files as the serial call
+- jobs sharing a run (e.g. [1, [1, 4]]) go to the same worker and run one
+  after another in their input order, as they would serially
+- the resulting run dicts are sent back without image data (as after LRU
+  eviction), images reload from the stack cache when they are needed again
+- a streaming run's frame reader (it reads through the worker's loader)
+  is dropped too, the next load of the run builds a new one
+- with profiling enabled, the stages recorded by the workers are merged
+  into the profile of the instrument
+
+On platforms that spawn worker processes (Windows, macOS) scripts using
+it need the usual `if __name__ == "__main__":` guard.
+"""
+
+import pickle
+
+from copy import copy
+from concurrent.futures import ProcessPoolExecutor
+
+from .cache import evict_images
+from .stream import FrameReader
+
+
+def _run_jobs(inst, method, jobs):
+    for args, kwargs, _ in jobs:
+        getattr(inst, method)(*args, **kwargs)
+    run_nos = [n for job in jobs for n in job[2]]
+    runs = {n: inst.runs[n] for n in run_nos if inst.runs.get(n)}
+    evict_images(runs, dict.fromkeys(runs), 0)
+    for a in runs.values():
+        if isinstance(a.get("img"), FrameReader):
+            del a["img"]
+    return runs, inst.profile.runs
+
+
+def _group(jobs):
+    """jobs grouped by shared runs, each group in input order"""
+    groups = []  # (job indices, runs)
+    for i, job in enumerate(jobs):
+        idx, runs = [i], set(job[2])
+        for g in [g for g in groups if g[1] & runs]:
+            groups.remove(g)
+            idx, runs = g[0] + idx, g[1] | runs
+        groups.append((sorted(idx), runs))
+    return [[jobs[i] for i in idx] for idx, _ in sorted(groups)]
+
+
+def run_batch(inst, method, jobs, processes):
+    """
+    call inst.method(*args, **kwargs) for each job in a pool of processes
+
+    jobs -- list of (args, kwargs, run_nos), run_nos are the runs the job
+    produces and that are returned
+    processes -- number of worker processes
+    returns {run: run dict} of all jobs, or None if a pool is not worth it
+    (a single job, or all jobs share runs) or inst can not be sent to worker
+    processes (e.g. a function as roic), the caller then runs serially
+    """
+    groups = _group(jobs)
+    if len(groups) < 2:
+        return
+    worker = copy(inst)
+    worker.runs, worker.lru = {}, {}
+    try:
+        pickle.dumps(worker)
+    except (pickle.PicklingError, AttributeError, TypeError) as e:
+        print("processes: running serially, settings can not be pickled ({})".format(e))
+        return
+
+    runs = {}
+    with ProcessPoolExecutor(min(processes, len(groups))) as pool:
+        futures = [pool.submit(_run_jobs, worker, method, g) for g in groups]
+        for f in futures:
+            r, profile = f.result()
+            runs.update(r)
+            inst.profile.merge(profile)
+    return runs
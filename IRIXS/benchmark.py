@@ -0,0 +1,587 @@
+""" irixs_benchmark: throughput of the reduction on synthetic data
+
+Writes a small synthetic experiment (P01 style .fio files and tiff stacks)
+and times the main steps of the reduction on it:
+
+    fio               load_fio / read_fio_data (as used by p01plot) on a long scan
+    load              irixs.load of a run from the remote folder, no stack cache
+    load_cached       irixs.load of the same run from the local stack cache
+    condition         irixs.condition, integrating
+    streaming_batch   irixs.condition of two runs, streaming, in 2 processes
+    photon_counting   irixs.condition, photon counting
+    distortion        irixs.calc_distortion
+    extract           spectrograph.extract of a greateyes run (bias corrected)
+    transform         spectrograph.transform
+    track_signal      spectrograph.track_signal
+    sixc_angles       sixc.angles for a batch of reflections
+
+Andor frames hold a curved elastic line of photon clusters on top of the
+detector offset and readout noise, greateyes frames a spot moving with
+the scan on four quadrants of different bias. Frames, frame size, count
+rate and line geometry are configurable, so the same cases can be run at
+beamline scale (--size 2048).
+
+Results are throughput numbers (frames, fio rows or MB per second, best
+of --repeat), the time relative to decoding the andor run's tiffs in the
+same process, and the peak resident memory (RSS) of each step (in an
+extra call). They can be saved as JSON and compared against an earlier
+run, e.g. of another version:
+
+    irixs_benchmark --save before.json
+    irixs_benchmark --compare before.json
+
+With --check every case is held to a performance budget (BUDGETS, or a
+JSON file of the same form given with --budgets) and the exit status is
+non-zero if one is exceeded, e.g. by a change that copies every frame or
+stacks frames from a list again. Budgets are relative, so that they hold
+on slower and faster machines alike, and set for the default synthetic
+data with a wide margin:
+
+    time            maximum time relative to decoding the andor run's tiffs
+    memory          maximum peak RSS per MB of the run's image data
+    peak MB         maximum peak RSS
+
+The same checks run as tests (tests/test_benchmark.py, pytest).
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import ctypes
+import gc
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+
+from contextlib import redirect_stdout
+
+from .tools import load_fio, flush_mirror
+
+EXP = "bench"
+RUN_ANDOR = 1
+RUN_GREATEYES = 2
+RUN_FIO = 3
+RUN_ANDOR_2 = 4  # second andor run (streaming_batch)
+
+CASES = [
+    "fio",
+    "load",
+    "load_cached",
+    "condition",
+    "streaming_batch",
+    "photon_counting",
+    "distortion",
+    "extract",
+    "transform",
+    "track_signal",
+    "sixc_angles",
+]
+
+ANDOR_OFFSET = 935  # detfac of the default irixs settings
+GREATEYES_BIAS = [400, 412, 396, 405]  # per quadrant
+PHOTON = [600, 150, 100]  # photon cluster: pixel, below, right
+SIXC_REFLECTIONS = 100
+
+BUDGETS = {
+    "fio": {"time": 1, "memory": 10},
+    "load": {"time": 12, "memory": 2},
+    "load_cached": {"time": 12, "memory": 1.5},
+    "condition": {"time": 3, "memory": 0.25},
+    "streaming_batch": {"time": 50, "memory": 0.25},
+    "photon_counting": {"time": 6, "memory": 1},
+    "distortion": {"time": 10, "memory": 0.5},
+    "extract": {"time": 25, "memory": 2},
+    "transform": {"time": 3, "memory": 0.25},
+    "track_signal": {"time": 6, "memory": 0.1},
+    "sixc_angles": {"time": 40, "peak MB": 5},
+}
+
+
+def write_fio(folder, run, pnts, motor="rixs_ener", energy=2838.5, width=2.0, exp=EXP):
+    """.fio file of a complete scan of motor over width around energy"""
+    lines = [
+        "!", "! Comments", "!", "%c",
+        "ascan {0} {1} {2} {3} 1.0".format(motor, -width / 2, width / 2, pnts - 1),
+        "user p01user Acquisition started at Mon Jan 11 10:00:00 2021",
+        "!", "! Parameter", "!", "%p",
+    ]
+    params = {
+        "dcm_ener": energy, "rixs_ener": energy, "rixs_th": 45.0, "rixs_chi": 0.0,
+        "rixs_sam_x": 0.0, "rixs_sam_y": 0.0, "rixs_sam_z": 0.0,
+    }
+    lines += ["{0} = {1}".format(k, v) for k, v in params.items()]
+    lines += ["!", "! Data", "!", "%d"]
+    cols = [motor, "sr_current", "t_sample", "q_h", "q_k", "q_l", "petra_beamcurrent"]
+    lines += [" Col {0} {1} DOUBLE".format(i + 1, c) for i, c in enumerate(cols)]
+    data = np.zeros((pnts, len(cols)))
+    data[:, 0] = energy + np.linspace(-width / 2, width / 2, pnts)
+    data[:, 1] = 100.0
+    data[:, 2] = 20.0
+    data[:, 5] = 1.0
+    data[:, 6] = 100.0
+    lines += [" " + " ".join("{0:.6f}".format(v) for v in row) for row in data]
+    lines.append("! Acquisition ended at Mon Jan 11 10:10:00 2021")
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, "{0}_{1:05d}.fio".format(exp, run)), "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def _add_photons(img, rows, cols):
+    for (dy, dx), v in zip([(0, 0), (1, 0), (0, 1)], PHOTON):
+        np.add.at(img, (rows + dy, cols + dx), v)
+
+
+def _tiff_folder(folder, run, detector, exp=EXP):
+    path = os.path.join(folder, "{0}_{1:05d}".format(exp, run), detector)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def write_andor(folder, run, frames, size, rate, y0=None, curvature=20, width=2, seed=0):
+    """
+    andor frames of an elastic line of photon clusters
+    - rate -- photons per frame
+    - y0 -- line centre (row) at the middle of the detector, default size/2
+    - curvature -- shift of the line at the detector edges (rows)
+    - width -- gaussian width of the line (rows)
+    """
+    import tifffile
+
+    rng = np.random.default_rng(seed)
+    path = _tiff_folder(folder, run, "andor")
+    y0 = size // 2 if y0 is None else y0
+    for i in range(frames):
+        img = rng.normal(ANDOR_OFFSET, 5, (size, size)).astype(np.int32)
+        n = rng.poisson(rate)
+        cols = rng.integers(0, size - 1, n)
+        line = y0 + curvature * ((2 * cols - size) / size) ** 2
+        rows = np.clip(np.rint(rng.normal(line, width)), 0, size - 2).astype(int)
+        _add_photons(img, rows, cols)
+        img[rng.integers(size), rng.integers(size)] += 5000  # cosmic
+        fname = "{0}_{1:05d}_{2:04d}.tiff".format(EXP, run, i)
+        tifffile.imwrite(os.path.join(path, fname), img)
+
+
+def write_greateyes(folder, run, frames, size, rate, yc=None, spot=6, seed=0):
+    """
+    greateyes frames of a spot (rate photons) moving horizontally with the
+    scan, centred on row yc, on four quadrants of different bias
+    """
+    import tifffile
+
+    rng = np.random.default_rng(seed)
+    path = _tiff_folder(folder, run, "greateyes")
+    yc = size // 2 if yc is None else yc
+    h = size // 2
+    bias = np.block([[np.full((h, h), b) for b in GREATEYES_BIAS[:2]],
+                     [np.full((h, h), b) for b in GREATEYES_BIAS[2:]]])
+    for i in range(frames):
+        img = (bias + rng.normal(0, 3, (size, size))).astype(np.int32)
+        xc = size * (0.3 + 0.4 * i / max(frames - 1, 1))
+        n = rng.poisson(rate)
+        rows = np.clip(np.rint(rng.normal(yc, spot, n)), 0, size - 2).astype(int)
+        cols = np.clip(np.rint(rng.normal(xc, spot, n)), 0, size - 2).astype(int)
+        _add_photons(img, rows, cols)
+        fname = "{0}_{1:05d}_{2:04d}.tiff".format(EXP, run, i)
+        tifffile.imwrite(os.path.join(path, fname), img)
+
+
+def synthesise(root, frames=20, size=1024, rate=200, fio_points=5000, curvature=20, seed=0):
+    """
+    write the benchmark experiment to root/remote, reused if it was already
+    written with the same settings
+    returns the remote data directory
+    """
+    settings = {
+        "frames": frames, "size": size, "rate": rate,
+        "fio_points": fio_points, "curvature": curvature, "seed": seed,
+        "andor_runs": [RUN_ANDOR, RUN_ANDOR_2],
+    }
+    remote = os.path.join(root, "remote")
+    stamp = os.path.join(remote, "synthetic.json")
+    try:
+        with open(stamp) as f:
+            if json.load(f) == settings:
+                return remote
+    except (OSError, ValueError):
+        pass
+    shutil.rmtree(remote, ignore_errors=True)
+    write_fio(remote, RUN_ANDOR, frames)
+    write_andor(remote, RUN_ANDOR, frames, size, rate, curvature=curvature, seed=seed)
+    write_fio(remote, RUN_ANDOR_2, frames)
+    write_andor(remote, RUN_ANDOR_2, frames, size, rate, curvature=curvature, seed=seed + 1)
+    write_fio(remote, RUN_GREATEYES, frames, motor="exp_dmy01")
+    write_greateyes(remote, RUN_GREATEYES, frames, size, rate, seed=seed)
+    write_fio(remote, RUN_FIO, fio_points)
+    with open(stamp, "w") as f:
+        json.dump(settings, f)
+    return remote
+
+
+def _time(setup, func, repeat):
+    """best wall time of func(setup()) over repeat calls, progress output hidden"""
+    best = np.inf
+    for _ in range(repeat):
+        with redirect_stdout(io.StringIO()):
+            state = setup()
+            t = time.perf_counter()
+            func(state)
+            best = min(best, time.perf_counter() - t)
+    return best
+
+
+def _rss():
+    """resident set size and its peak (bytes), None without /proc (Linux)"""
+    try:
+        with open("/proc/self/status") as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+        return [int(status[k].split()[0]) * 1024 for k in ["VmRSS", "VmHWM"]]
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _reset_peak_rss():
+    """
+    reset the peak RSS of the process to the current RSS, True if possible
+    - memory freed but kept by malloc is returned first, otherwise a step
+      reusing it would not show in the RSS
+    """
+    try:
+        ctypes.CDLL(None).malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return _rss() is not None
+    except OSError:
+        return False
+
+
+def _peak(setup, func):
+    """
+    peak resident memory (bytes) of func(setup()), above what setup left
+    - memory of worker processes (streaming_batch) is not included
+    - where the peak RSS cannot be reset (not Linux) the peak of the memory
+      allocated, as traced by tracemalloc, is used instead
+    """
+    with redirect_stdout(io.StringIO()):
+        state = setup()
+        gc.collect()
+        if _reset_peak_rss():
+            base = _rss()[0]
+            func(state)
+            return max(_rss()[1] - base, 0)
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        try:
+            func(state)
+            return tracemalloc.get_traced_memory()[1] - base
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+
+
+def _reference(remote, repeat):
+    """
+    best wall time of decoding the tiffs of the andor run, the least an image
+    case does with a run: times relative to it do not depend on the machine
+    """
+    import tifffile
+
+    path = os.path.join(remote, "{0}_{1:05d}".format(EXP, RUN_ANDOR), "andor")
+    files = [os.path.join(path, f) for f in sorted(os.listdir(path))]
+    return _time(lambda: None, lambda _: [tifffile.imread(f).sum() for f in files], repeat)
+
+
+def _sixc_batch():
+    """sixc of the README example and reflections reachable with it"""
+    from .ub import sixc
+
+    f = sixc([5.37, 5.60, 19.35, 90, 90, 90], (0, 0, 4), (1, 0, 0), [29.85, 53.70, 2.0])
+    th = np.linspace(20, 70, SIXC_REFLECTIONS)
+    return f, [f.hkl(t, 90, 2.0) for t in th]
+
+
+def _run_bytes(remote, run, detector):
+    path = os.path.join(remote, "{0}_{1:05d}".format(EXP, run), detector)
+    return sum(e.stat().st_size for e in os.scandir(path))
+
+
+def run_benchmarks(root, cases=None, repeat=3, **synth):
+    """
+    time the benchmark cases on the synthetic experiment in root
+    (instruments write their outputs to root as well)
+
+    cases -- names from CASES, all by default
+    repeat -- best of this many calls per case
+    synth -- settings of synthesise (frames, size, rate, ...)
+    returns a list of
+    {case, seconds, items, unit, rate, MB/s, relative, peak MB, data MB}
+    where relative is the time relative to decoding the andor run (_reference)
+    """
+    from .instrument_rowland import irixs
+    from .instrument_spectrograph import spectrograph
+
+    cases = CASES if cases is None else cases
+    unknown = set(cases) - set(CASES)
+    if unknown:
+        raise ValueError("unknown benchmark cases: {}".format(", ".join(sorted(unknown))))
+
+    cwd = os.getcwd()
+    remote = os.path.abspath(synthesise(root, **synth))
+    with open(os.path.join(remote, "synthetic.json")) as f:
+        settings = json.load(f)
+    size, frames = settings["size"], settings["frames"]
+    y0 = size // 2
+    kw_irixs = {
+        "y0": y0, "roix": [0, size], "roiy": [y0 - 100, y0 + 100], "roih": [-100, 100],
+        "datdir_remote": remote, "datdir_local": None, "cache": False,
+    }
+    kw_spec = {
+        "roix": [0, size], "roih": 100, "roic": size // 2,
+        "detector_type": "greateyes", "datdir_remote": remote, "cache": False,
+    }
+    mb_andor = _run_bytes(remote, RUN_ANDOR, "andor") / 1e6
+    mb_andor_2 = _run_bytes(remote, RUN_ANDOR_2, "andor") / 1e6
+    mb_greateyes = _run_bytes(remote, RUN_GREATEYES, "greateyes") / 1e6
+    fio_path = os.path.join(remote, "{0}_{1:05d}.fio".format(EXP, RUN_FIO))
+    fio_rows = settings["fio_points"]
+
+    def loaded(**kw):
+        def setup():
+            a = irixs(EXP, **dict(kw_irixs, **kw))
+            a.load(RUN_ANDOR)
+            return a
+        return setup
+
+    def spec(extract=True, transform=False):
+        def setup():
+            local = os.path.join(root, "local")
+            flush_mirror()
+            shutil.rmtree(local, ignore_errors=True)
+            s = spectrograph(EXP, datdir_local=local, **kw_spec)
+            if extract:
+                s.extract(RUN_GREATEYES)
+            if transform:
+                s.transform(RUN_GREATEYES, fit=False)
+            return s
+        return setup
+
+    def cached_setup():
+        local = os.path.join(root, "local")
+        kw = dict(kw_irixs, datdir_local=local, cache=True)
+        a = irixs(EXP, **kw)
+        a.load(RUN_ANDOR)  # fills the stack cache (only slow the first time)
+        flush_mirror()
+        return irixs(EXP, **kw)
+
+    table = {
+        "fio": (
+            lambda: None,
+            lambda _: load_fio(RUN_FIO, EXP, remote),
+            fio_rows, "rows", os.path.getsize(fio_path) / 1e6,
+        ),
+        "load": (
+            lambda: irixs(EXP, **kw_irixs),
+            lambda a: a.load(RUN_ANDOR),
+            frames, "frames", mb_andor,
+        ),
+        "load_cached": (
+            cached_setup,
+            lambda a: a.load(RUN_ANDOR),
+            frames, "frames", mb_andor,
+        ),
+        "condition": (
+            loaded(),
+            lambda a: a.condition(0.01, RUN_ANDOR),
+            frames, "frames", mb_andor,
+        ),
+        "streaming_batch": (
+            lambda: irixs(EXP, **dict(kw_irixs, streaming=True)),
+            lambda a: a.condition(0.01, [RUN_ANDOR, RUN_ANDOR_2], processes=2),
+            2 * frames, "frames", mb_andor + mb_andor_2,
+        ),
+        "photon_counting": (
+            loaded(photon_counting=True),
+            lambda a: a.condition(0.01, RUN_ANDOR),
+            frames, "frames", mb_andor,
+        ),
+        "distortion": (
+            loaded(),
+            lambda a: a.calc_distortion(RUN_ANDOR),
+            frames, "frames", mb_andor,
+        ),
+        "extract": (
+            spec(extract=False),
+            lambda s: s.extract(RUN_GREATEYES),
+            frames, "frames", mb_greateyes,
+        ),
+        "transform": (
+            spec(),
+            lambda s: s.transform(RUN_GREATEYES),
+            frames, "frames", mb_greateyes,
+        ),
+        "track_signal": (
+            spec(transform=True),
+            lambda s: s.track_signal(RUN_GREATEYES, plot=False),
+            frames, "frames", mb_greateyes,
+        ),
+        "sixc_angles": (
+            _sixc_batch,
+            lambda b: [b[0].angles(*hkl) for hkl in b[1]],
+            SIXC_REFLECTIONS, "angles", 0,
+        ),
+    }
+
+    results = []
+    try:
+        os.chdir(root)
+        reference = _reference(remote, repeat)
+        for case in cases:
+            setup, func, items, unit, mb = table[case]
+            dt = _time(setup, func, repeat)
+            results.append({
+                "case": case, "seconds": dt, "items": items, "unit": unit,
+                "rate": items / dt, "MB/s": mb / dt, "relative": dt / reference,
+                "peak MB": _peak(setup, func) / 1e6, "data MB": mb,
+            })
+    finally:
+        flush_mirror()
+        os.chdir(cwd)
+    return results
+
+
+def environment():
+    """versions and machine the results were measured with"""
+    import scipy
+
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def summary(results, baseline=None):
+    """table of results, with the speed-up against baseline results if given"""
+    from tabulate import tabulate
+
+    base = {r["case"]: r for r in baseline or []}
+    rows = []
+    for r in results:
+        row = [
+            r["case"], "{:.3f}".format(r["seconds"]),
+            "{:.1f} {}/s".format(r["rate"], r["unit"]),
+            "{:.1f}".format(r["MB/s"]) if r["data MB"] else "",
+            "{:.2f}".format(r["relative"]),
+            "{:.1f}".format(r["peak MB"]),
+        ]
+        if baseline is not None:
+            b = base.get(r["case"])
+            row.append("{:.2f}x".format(b["seconds"] / r["seconds"]) if b else "")
+        rows.append(row)
+    headers = ["case", "seconds", "throughput", "MB/s", "relative", "peak MB"]
+    if baseline is not None:
+        headers.append("vs baseline")
+    return tabulate(rows, headers=headers)
+
+
+def check(results, budgets=None):
+    """list of the budgets (see BUDGETS) the results exceed"""
+    budgets = BUDGETS if budgets is None else budgets
+    failed = []
+    for r in results:
+        for k, limit in budgets.get(r["case"], {}).items():
+            if k == "memory":
+                value = r["peak MB"] / r["data MB"]
+            elif k == "time":
+                value = r["relative"]
+            else:
+                value = r[k]
+            if value > limit:
+                failed.append("{0}: {1} {2:.2f} > {3}".format(r["case"], k, value, limit))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="irixs_benchmark",
+        description="throughput of the reduction on synthetic data",
+    )
+    parser.add_argument("--frames", type=int, default=20, help="frames per run")
+    parser.add_argument("--size", type=int, default=1024, help="frame size (pixels)")
+    parser.add_argument("--rate", type=int, default=200, help="photons per frame")
+    parser.add_argument("--fio-points", type=int, default=5000, help="rows of the fio case")
+    parser.add_argument(
+        "--curvature", type=float, default=20, help="elastic line shift at the edges (rows)"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="best of this many calls")
+    parser.add_argument(
+        "--cases", help="comma separated cases, default all: {}".format(",".join(CASES))
+    )
+    parser.add_argument("--workdir", help="keep the synthetic data and outputs here")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare to")
+    parser.add_argument(
+        "--check", action="store_true", help="exit non-zero if a budget is exceeded"
+    )
+    parser.add_argument("--budgets", help="JSON file of budgets to check instead of BUDGETS")
+    args = parser.parse_args()
+
+    os.environ["MPLBACKEND"] = "Agg"
+    cases = args.cases.split(",") if args.cases else None
+    synth = ["frames", "size", "rate", "fio_points", "curvature"]
+    settings = {k: getattr(args, k) for k in synth + ["repeat"]}
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)
+        baseline = base["results"]
+        if any(base["settings"].get(k) != settings[k] for k in synth):
+            print("irixs_benchmark: {} was run on other synthetic data".format(args.compare))
+    budgets = None
+    if args.budgets:
+        with open(args.budgets) as f:
+            budgets = json.load(f)
+
+    root = args.workdir or tempfile.mkdtemp(prefix="irixs_benchmark_")
+    os.makedirs(root, exist_ok=True)
+    try:
+        results = run_benchmarks(
+            os.path.abspath(root), cases, args.repeat, **{k: settings[k] for k in synth}
+        )
+    except ValueError as e:
+        sys.exit("irixs_benchmark: {}".format(e))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print(summary(results, baseline))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {"settings": settings, "environment": environment(), "results": results},
+                f, indent=2,
+            )
+
+    if args.check:
+        failed = check(results, budgets)
+        if failed:
+            print("\nover budget:\n" + "\n".join(failed))
+            sys.exit(1)
+        print("\nwithin budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+""" on-disk cache of thresholded detector image stacks
+
+One compressed .npz file per run is kept under <datdir_local>/cache,
+holding the processed stack together with the parameters that produced it
+and a signature of the source tiff files. A cached stack is only used if
+both still match, so changing threshold, cutoff, detfac, bias correction
+or the tiff files themselves invalidates it automatically.
+Sparse stacks are stored as their pixel lists and loaded back as such.
+
+The in-memory run cache (the runs dict of irixs and spectrograph) can be
+held to a memory budget: evict_images drops the image data of the least
+recently used runs, keeping metadata and reduced results. Evicted runs
+are reloaded (from the stack cache if present) the next time they are used.
+"""
+
+import os
+import json
+import zipfile
+import tempfile
+import numpy as np
+
+from .sparse import SparseStack
+from .tools import flush_mirror, count_read
+
+CACHE_DIR = "cache"
+
+
+def cache_path(localdir, exp, run, detector="andor"):
+    """location of the cache file for a run"""
+    fname = "{0}_{1:05d}_{2}.npz".format(exp, run, detector)
+    return os.path.join(localdir, CACHE_DIR, fname)
+
+
+def source_signature(run, exp, datdir, localdir, detector="andor"):
+    """
+    names, sizes and modification times of the tiff files of a run
+    - uses the local copy if present (that is what load_tiff reads),
+      after any local copies still being written have been finished
+    """
+    flush_mirror()
+    folder = "{0}_{1:05d}".format(exp, run)
+    for root in [localdir, datdir]:
+        if not root:
+            continue
+        path = os.path.join(root, folder, detector)
+        try:
+            with os.scandir(path) as it:
+                sig = []
+                for e in it:
+                    if e.name.endswith(".tiff"):
+                        st = e.stat()
+                        sig.append([e.name, st.st_size, st.st_mtime_ns])
+            return sorted(sig)
+        except OSError:
+            continue
+    return []
+
+
+def _key(params, signature):
+    # normalise through json so that tuples/lists and numpy scalars compare equal
+    return json.loads(json.dumps({"params": params, "source": signature}, default=float))
+
+
+def load_cache(path, params, signature):
+    """
+    return the cached image stack if it was produced from the same
+    parameters and source files, otherwise None
+    """
+    if not signature:
+        return
+    try:
+        with np.load(path) as f:
+            if json.loads(str(f["key"])) != _key(params, signature):
+                return
+            count_read(path)
+            if "ptr" in f:
+                return SparseStack.from_arrays(f)
+            return f["stack"]
+    except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+        return  # missing, stale or truncated: rebuilt by the caller
+
+
+def save_cache(path, stack, params, signature):
+    """
+    store a processed image stack, replacing any previous cache file
+    - written to a temporary file of its own and moved into place, so
+      concurrent writers of the same run (batch jobs, the mirror) never
+      see or replace a half-written file
+    """
+    if not signature:
+        return
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    key = json.dumps(_key(params, signature))
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", dir=folder)
+        with os.fdopen(fd, "wb") as f:
+            if isinstance(stack, SparseStack):
+                np.savez_compressed(f, key=np.array(key), **stack.arrays())
+            else:
+                np.savez_compressed(f, stack=stack, key=np.array(key))
+        os.replace(tmp, path)
+    except OSError:
+        print("cache: failed to write {}".format(path))
+        if tmp:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
+def image_bytes(a):
+    """memory held by the image data of a run"""
+    if not a:
+        return 0
+    stack = a.get("stack")
+    if stack is None:
+        stack = a.get("img")
+    return int(getattr(stack, "nbytes", 0))
+
+
+def touch(lru, run):
+    """mark a run as most recently used"""
+    lru.pop(run, None)
+    lru[run] = None
+
+
+def evict_images(runs, lru, max_bytes, keep=()):
+    """
+    drop image data of the least recently used runs until their total
+    memory is within max_bytes
+    - runs in keep (e.g. those currently being processed) are never evicted
+    - returns the evicted run numbers
+    """
+    if max_bytes is None:
+        return []
+    total = sum(image_bytes(runs.get(n)) for n in lru)
+    evicted = []
+    for n in list(lru):
+        if total <= max_bytes:
+            break
+        size = image_bytes(runs.get(n))
+        if n in keep or not size:
+            continue
+        a = runs[n]
+        for k in ["img", "stack", "imgr"]:
+            a.pop(k, None)
+        if "trans" in a:  # per-frame views into the stack
+            a["trans"].pop("imgr", None)
+        if "nimg" in a:
+            a["nimg"] = 0
+        total -= size
+        lru.pop(n)
+        evicted.append(n)
+    return evicted
@@ -0,0 +1,51 @@
+""" detector distortion (elastic line curvature) correction """
+
+import numpy as np
+
+
+def fit_curvature(cols, centres, order=2):
+    """polynomial model of the elastic line centre as a function of detector column"""
+    order = min(order, len(cols) - 1)
+    return np.polyfit(cols, centres, order)
+
+
+def column_shift(poly, y0, cols):
+    """vertical (sub-pixel) shift moving the elastic line at each column onto y0"""
+    return y0 - np.polyval(poly, cols)
+
+
+def distortion_map(shift, rows, ny):
+    """
+    precompute the gather map that straightens an image
+    - output pixel (r, c) = (1 - w) * img[r - k, c] + w * img[r - k - 1, c]
+      where the column shift is k + w (k integer, 0 <= w < 1)
+    - rows wrap around the detector height, as with np.roll
+
+    shift -- shift of each column
+    rows -- output rows, e.g. the vertical ROI
+    ny -- detector height
+    returns row indices (2, rows, cols) and weights (2, cols)
+    """
+    k = np.floor(shift).astype(int)
+    w = shift - k
+    idx0 = (np.asarray(rows)[:, None] - k[None, :]) % ny
+    idx1 = (idx0 - 1) % ny
+    return np.stack([idx0, idx1]), np.stack([1 - w, w])
+
+
+def remap(img, dmap):
+    """apply a distortion map to a (frames, ny, cols) stack in a single gather"""
+    idx, w = dmap
+    cols = np.arange(idx.shape[2])
+    return img[:, idx[0], cols] * w[0] + img[:, idx[1], cols] * w[1]
+
+
+def remap_sum(img, dmap, chunk=32):
+    """
+    row sums (frames, rows) of a remapped (frames, ny, cols) stack
+    - frames are remapped in chunks to bound the temporary memory
+    """
+    out = np.empty((img.shape[0], dmap[0].shape[1]))
+    for i in range(0, img.shape[0], chunk):
+        out[i : i + chunk] = np.sum(remap(img[i : i + chunk], dmap), axis=2)
+    return out
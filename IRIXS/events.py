@@ -0,0 +1,99 @@
+""" photon event finding on detector image stacks """
+
+import numpy as np
+
+# pixels only connect within a frame (4-connectivity), never across frames
+STRUCTURE = np.zeros((3, 3, 3), dtype=bool)
+STRUCTURE[1] = [[0, 1, 0], [1, 1, 1], [0, 1, 0]]
+
+
+def find_events(img, row0=0, col0=0):
+    """
+    find contiguous detector events in all frames of a (frames, ny, nx) stack
+    - frames are labelled in a single pass, events are reduced with bincount
+    - events are ordered by frame, then as scipy.ndimage.label numbers them
+    - row0, col0: detector position of img[:, 0, 0] (e.g. the ROI origin)
+
+    returns dict of per-event arrays:
+        frame -- index of the frame the event was found in
+        sum -- summed intensity
+        row, col -- mean detector pixel position
+        row_com, col_com -- intensity-weighted (sub-pixel) centroid
+        npix -- number of pixels
+    """
+    import scipy.ndimage
+
+    img = np.asarray(img)
+    if img.ndim == 2:
+        img = img[None]
+    lbl, nlbl = scipy.ndimage.label(img, structure=STRUCTURE)
+
+    # only pixels that belong to an event take part in the reductions
+    pix = np.flatnonzero(lbl)
+    lab = lbl.ravel()[pix]
+    frame, row, col = np.unravel_index(pix, img.shape)
+
+    nbin = nlbl + 1
+    val = img.ravel()[pix]
+    row, col = row + row0, col + col0
+    npix = np.bincount(lab, minlength=nbin)[1:]
+    ev = {"npix": npix}
+    ev["sum"] = np.bincount(lab, weights=val, minlength=nbin)[1:]
+    ev["row"] = np.bincount(lab, weights=row, minlength=nbin)[1:] / npix
+    ev["col"] = np.bincount(lab, weights=col, minlength=nbin)[1:] / npix
+    with np.errstate(divide="ignore", invalid="ignore"):
+        wrow = np.bincount(lab, weights=val * row, minlength=nbin)[1:]
+        wcol = np.bincount(lab, weights=val * col, minlength=nbin)[1:]
+        ev["row_com"], ev["col_com"] = wrow / ev["sum"], wcol / ev["sum"]
+    ev["frame"] = np.zeros(nlbl, dtype=int)
+    ev["frame"][lab - 1] = frame
+    return ev
+
+
+def eta_correct(pos, bins=100):
+    """
+    eta correction of sub-pixel event positions
+    - charge sharing pulls centroids towards pixel centres/edges, so the
+      fractional position (eta) is not uniformly distributed
+    - eta is mapped through its own cumulative distribution, which spreads
+      events evenly across each pixel
+    """
+    pos = np.asarray(pos, dtype=float)
+    if not len(pos):
+        return pos
+    pix = np.floor(pos + 0.5)
+    eta = pos - pix + 0.5  # 0..1 across the pixel
+    hist, edges = np.histogram(eta, bins=bins, range=(0, 1))
+    cdf = np.concatenate([[0], np.cumsum(hist)]) / len(eta)
+    return pix - 0.5 + np.interp(eta, edges, cdf)
+
+
+def centroids(ev, mode="com", axis="row"):
+    """
+    event positions along a detector axis ("row" or "col")
+    mode -- "mean": unweighted pixel mean
+            "com": intensity-weighted centroid
+            "eta": intensity-weighted centroid with eta correction
+    """
+    if mode == "mean":
+        return ev[axis]
+    if mode == "com":
+        return ev[axis + "_com"]
+    if mode == "eta":
+        return eta_correct(ev[axis + "_com"])
+    raise ValueError("unknown centroid mode: {}".format(mode))
+
+
+def split_events(x, y, max_events):
+    """
+    split events holding several photons
+    - events with intensity around i (i <= max_events) photons are replaced by
+      i events of intensity y / i at the same position
+    - events above max_events + 0.5 are dropped
+    """
+    keep = y <= max_events + 0.5
+    x, y = x[keep], y[keep]
+    mult = np.ones(len(y), dtype=int)
+    for i in range(max_events, 1, -1):
+        mult[(y >= i - 0.5) & (y < i + 0.5)] = i
+    return np.repeat(x, mult), np.repeat(y / mult, mult)
@@ -4,27 +4,27 @@ import os
 import sys
 import shutil
 import numpy as np
-import matplotlib.pyplot as plt
-import scipy.ndimage
 
 from numpy import pi, cos, tan, arcsin
-from matplotlib.patches import Rectangle
-from mpl_toolkits.axes_grid1 import make_axes_locatable
 from copy import deepcopy
-from glob import iglob
 
-from .tools import load_fio, load_tiff
-from .tools import calc_dspacing, binning, peak_fit, flatten
+from .tools import load_fio, load_tiff, map_frames, alloc_stack, grow_stack
+from .tools import calc_dspacing, peak_fit, peak_fit_batch, flatten, pyplot
+from .tools import bin_edges, bin_init, bin_add, bin_result
+from .cache import cache_path, source_signature, load_cache, save_cache
+from .cache import touch, evict_images
+from .runindex import run_index, latest_run
+from .mirror import Mirror, cache_worker
+from .batch import run_batch
+from .profiling import Profiler
+from .sparse import SparseStack, convert_stack
+from .stream import chunks, add_total, FrameReader
+from .events import find_events, centroids, split_events
+from .distortion import fit_curvature, column_shift, distortion_map, remap, remap_sum
 
 PIX_EN_CONV = 13.5e-6  # andor detector pixel size
 SR_LIMIT = 50  # minimum ring current in mA to identify beam dump
 
-plt.rcParams["xtick.top"] = True
-plt.rcParams["ytick.right"] = True
-plt.rcParams["font.size"] = 8
-plt.rcParams["axes.titlesize"] = "medium"
-plt.rcParams["figure.titlesize"] = "medium"
-
 
 def pix_to_E(energy, dspacing):
     """convert y-axis pixel position to energy dispersion from analyser"""
@@ -53,8 +53,15 @@ class irixs:
         photon_counting=False,
         photon_event_threshold=400,
         photon_max_events=0,
+        photon_centroid="mean",
         datdir_remote="/gpfs/current/raw",
-        datdir_local="raw"
+        datdir_local="raw",
+        io_workers=4,
+        cache=True,
+        sparse=False,
+        streaming=False,
+        max_cache_bytes=None,
+        profile=None,
     ):
         """
         exp -- experiment filename prefix
@@ -82,6 +89,26 @@ class irixs:
         photon_event_threshold -- threshold intensity for a contigous detector event
         photon_max_events -- maximum multiple events to correct for (0 to disable correction)
         - photon_counting only works if the count rate on the detector is low
+        photon_centroid -- vertical position assigned to each photon event
+        - "mean": mean row of the event pixels
+        - "com": intensity-weighted centroid (sub-pixel)
+        - "eta": intensity-weighted centroid with eta correction
+
+        io_workers -- number of threads fetching, decoding and thresholding tiffs
+        - 1 loads frames one after another
+        cache -- keep thresholded image stacks of completed runs in datdir_local/cache
+        - rebuilt automatically if threshold, cutoff, detfac or the tiffs change
+        sparse -- store only the pixels surviving threshold/cutoff (see sparse.py)
+        - uses a fraction of the memory at typical count rates
+        streaming -- reduce every frame as soon as it is loaded, keep no image stack
+        - only ROI projections, the total image and condition data are kept
+        - frames are read back from disk when needed (check_run)
+        max_cache_bytes -- memory budget for image data of loaded runs (None: no limit)
+        - image data of the least recently used runs is dropped to stay within it,
+          metadata and results are kept, images reload when the run is used again
+        profile -- record time, bytes read and peak memory of load, condition and
+        detector for every run in self.profile (see profiling.py)
+        - None: only if the IRIXS_PROFILE environment variable is set
         """
 
         self.exp = exp
@@ -101,6 +128,7 @@ class irixs:
         self.photon_counting = photon_counting
         self.event_min = photon_event_threshold
         self.max_events = photon_max_events
+        self.centroid = photon_centroid
 
         quartz = [(1, 0, 2), (4.9133, 4.9133, 5.4053, 90, 90, 120)]
         self.analyser = quartz if analyser is None else analyser
@@ -108,6 +136,14 @@ class irixs:
 
         self.datdir = datdir_remote
         self.localdir = datdir_local
+        self.io_workers = io_workers
+        self.cache = cache
+        self.sparse = sparse
+        self.streaming = streaming
+        self.max_cache_bytes = max_cache_bytes
+        self.lru = {}  # run numbers, least recently used first
+        self.profile = Profiler(profile)
+        self.quiet = False  # no progress output from load (see mirror.cache_worker)
         if self.localdir:
             os.makedirs(self.localdir, exist_ok=True)
 
@@ -120,20 +156,30 @@ class irixs:
         os.makedirs(self.savedir_det, exist_ok=True)
         os.makedirs(self.savedir_fig, exist_ok=True)
 
-        self.corr_shift = False  # distortion correction
+        # distortion correction: elastic line centre vs detector column
+        self.corr_poly = None
+        self.corr_y0 = None
+        self.corr_maps = {}
 
-    def load(self, run_nos, load_images=True):
+    def load(self, run_nos, load_images=True, use_distortion_corr=True):
         """
         load data & parameters from fio and tiff files
         - stores runs as dicts in the self.runs dict
         - only copies to local directory when a run is completed
         - .fio files loaded first
         - performs tiff thresholding and cutoff (and stores values used)
+        - images are stored in a preallocated (pnts, ny, nx) stack, a["img"]
+          (or a SparseStack of the nonzero pixels with sparse=True)
+          is a view of the frames loaded so far
+        - completed runs are read from / written to the local stack cache
+        - with max_cache_bytes, images of other (least recently used) runs are
+          dropped afterwards
         - stores parameters to be used for data conditioning later
         - should be smart enough to only reload/recondition runs when necessary
 
         runs -- numbers of runs, can be given as single run or list or list of lists
         load_images -- only load image data if True
+        use_distortion_corr -- (streaming) reduce frames with the distortion correction
         """
 
         if not isinstance(run_nos, (list, tuple, range)):
@@ -144,7 +190,7 @@ class irixs:
             if n not in self.runs.keys():
                 self.runs[n] = None
 
-        for n in run_nos:
+        for n in self.profile.each(run_nos, "load.fio"):
 
             if self.runs[n] and self.runs[n]["complete"]:
                 continue
@@ -173,6 +219,15 @@ class irixs:
             else:
                 a["EF"] = a["data"]["rixs_ener"]
 
+            # keep images already loaded for a run that is still in progress
+            b = self.runs[n]
+            if b and "nimg" in b:
+                keep = [
+                    "img", "stack", "nimg", "threshold", "cutoff", "detfac",
+                    "to", "co", "acc", "total", "proj_x", "proj_y",
+                ]
+                a.update({k: b[k] for k in keep if k in b})
+
             self.runs[n] = a
 
         if not load_images:
@@ -181,7 +236,7 @@ class irixs:
         to = self.threshold - self.detfac
         co = self.cutoff - self.detfac
 
-        for n in run_nos:
+        for n in self.profile.each(run_nos, "load"):
 
             a = self.runs[n]
             if not a:
@@ -194,7 +249,7 @@ class irixs:
                     try:
                         y0 = self.y0_fallback
                     except AttributeError:
-                        print("#{0:<4} -- y0 not given".format(n))
+                        self._say("#{0:<4} -- y0 not given".format(n))
                         continue
             else:
                 y0 = self.y0
@@ -207,41 +262,256 @@ class irixs:
                 roiy = self.roiy
 
             a["roix"], a["roiy"], a["y0"] = self.roix, roiy, y0
+            touch(self.lru, n)
 
-            if "to" in a and to == a["to"] and co == a["co"] and a["complete"]:
+            if self.streaming:
+                self.stream(n, to, co, use_distortion_corr)
                 continue
 
-            if "img" not in a or a["img"] is None:
+            if (
+                "to" in a and to == a["to"] and co == a["co"]
+                and a["complete"] and a["nimg"] == a["pnts"]
+            ):
+                continue
+
+            if self.cache and self.localdir and a["complete"]:
+                cache = cache_path(self.localdir, self.exp, n)
+                params = self._cache_params()
+                source = source_signature(n, self.exp, self.datdir, self.localdir)
+            else:
+                cache = None
+
+            if a.get("stack") is None and cache:
+                stack = load_cache(cache, params, source)
+                if stack is not None:
+                    a["stack"], a["nimg"] = stack, len(stack)
+                    a["to"], a["co"], a["detfac"] = to, co, self.detfac
+
+            if a.get("stack") is None:
                 imtest = load_tiff(0, n, self.exp, self.datdir, self.localdir)
                 if imtest is None:
-                    print("#{0:<4} -- no images".format(n))
+                    self._say("#{0:<4} -- no images".format(n))
                     a["img"] = None
                     continue
+                # reserve the full scan length so frames arrive in place
+                try:
+                    planned = int(float(a["command"][-2])) + 1
+                except (IndexError, ValueError):
+                    planned = a["pnts"]
+                if self.sparse:
+                    a["stack"] = SparseStack(imtest.shape, imtest.dtype)
                 else:
-                    a["img"] = []
-
-            for i, _ in enumerate(a["EF"]):
-                if i > len(a["img"]) - 1:
+                    a["stack"] = alloc_stack(max(planned, a["pnts"]), imtest)
+                a["nimg"] = 0
+            else:
+                a["stack"] = convert_stack(a["stack"], a["nimg"], self.sparse)
+                if not self.sparse:
+                    a["stack"] = grow_stack(a["stack"], a["pnts"])
+
+            # threshold, cutoff or detfac changed: reprocess every frame
+            if a.get("to") != to or a.get("co") != co or a.get("detfac") != self.detfac:
+                a["nimg"] = 0
+            if self.sparse:  # frames are appended
+                a["stack"].truncate(a["nimg"])
+
+            def load_frame(i, n=n):
+                with self.profile(n, "load.read"):
                     img = load_tiff(i, n, self.exp, self.datdir, self.localdir)
-                    if img is None:
-                        print("!!!")
-                        break
-                    if img is not None:
+                if img is not None:
+                    with self.profile(n, "load.threshold"):
                         img -= self.detfac
                         img[~np.logical_and(img > to, img < co)] = 0
-                        a["img"].append(img)
-                    sys.stdout.write(
-                        "\r#{0:<4} {1:<3}/{2:>3} ".format(n, i + 1, a["pnts"])
-                    )
-                    if i + 1 == a["pnts"]:
-                        sys.stdout.write("\n")
-                    sys.stdout.flush()
+                return img
+
+            stack = a["stack"]
+            frames = range(a["nimg"], a["pnts"])
+            fresh = len(frames) > 0
+            for i, img in zip(frames, map_frames(load_frame, frames, self.io_workers)):
+                if img is None:
+                    self._say("!!!")
+                    break
+                stack[i] = img
+                a["nimg"] = i + 1
+                self._say(
+                    "\r#{0:<4} {1:<3}/{2:>3} ".format(n, i + 1, a["pnts"]),
+                    end="\n" if i + 1 == a["pnts"] else "",
+                )
+
+            # contiguous view of the frames loaded so far
+            a["img"] = stack[: a["nimg"]]
+
+            if cache and fresh and a["nimg"] == a["pnts"]:
+                with self.profile(n, "load.cache"):
+                    source = source_signature(n, self.exp, self.datdir, self.localdir)
+                    save_cache(cache, a["img"], params, source)
 
             a["threshold"] = self.threshold
             a["cutoff"] = self.cutoff
             a["detfac"] = self.detfac
             a["to"], a["co"] = to, co
 
+        evict_images(self.runs, self.lru, self.max_cache_bytes, keep=run_nos)
+
+    def accumulate(self, a, nf, use_distortion_corr=True):
+        """
+        per-run accumulator of the image reduction used by condition
+        - integrating: (frames, rows) sums inside the ROI
+        - photon counting: events of every frame
+        - only frames added since the last call are processed, everything is
+          redone if the ROI, thresholds or distortion correction change
+        """
+        key = self._acc_key(a, a["to"], a["co"], a["detfac"], use_distortion_corr)
+        acc = a.get("acc")
+        if acc is None or acc["key"] != key or acc["nf"] > nf:
+            acc = {"key": key, "nf": 0, "rows": None, "ev": None}
+            a["acc"] = acc
+        if acc["nf"] < nf:
+            with self.profile(a.get("no"), "condition.reduce"):
+                self._reduce(a, acc, a["img"][acc["nf"] : nf], use_distortion_corr)
+        return acc
+
+    def _acc_key(self, a, to, co, detfac, use_distortion_corr):
+        """parameters the condition accumulator of a run depends on"""
+        key = [a["roix"], a["roiy"], to, co, detfac, self.photon_counting]
+        if self.photon_counting:
+            key.append(self.event_min)
+        elif use_distortion_corr and self.corr_poly is not None:
+            key.append((list(self.corr_poly), self.corr_y0))
+        return str(key)
+
+    def _reduce(self, a, acc, img, use_distortion_corr):
+        """add the next block of frames to the condition accumulator"""
+        roix, roiy, f0 = a["roix"], a["roiy"], acc["nf"]
+        if self.photon_counting:
+            # label events of all new frames in one pass
+            crop = img[:, roiy[0] : roiy[1], roix[0] : roix[1]]
+            ev = find_events(crop, roiy[0], roix[0])
+            sel = ev["sum"] > self.event_min
+            ev = {k: v[sel] for k, v in ev.items()}
+            ev["frame"] += f0
+            if acc["ev"] is not None:
+                ev = {k: np.concatenate([acc["ev"][k], v]) for k, v in ev.items()}
+            acc["ev"] = ev
+        else:
+            rows = self.row_sums(img, roix, roiy, use_distortion_corr)
+            if acc["rows"] is not None:
+                rows = np.concatenate([acc["rows"], rows])
+            acc["rows"] = rows
+        acc["nf"] = f0 + len(img)
+
+    def stream(self, n, to, co, use_distortion_corr=True):
+        """
+        streaming load of a run (streaming=True)
+        - frames are reduced in blocks straight after loading and then dropped:
+          condition accumulator, ROI row/column projections (detector) and
+          the running total image
+        - continues where the previous call stopped for runs in progress,
+          starts over if thresholds, ROI or distortion correction changed
+        - a["img"] reads frames back from disk on demand
+        """
+        a = self.runs[n]
+        key = self._acc_key(a, to, co, self.detfac, use_distortion_corr)
+        acc = a.get("acc")
+        if acc is None or acc["key"] != key:
+            acc = {"key": key, "nf": 0, "rows": None, "ev": None}
+            a["acc"], a["total"], a["proj_x"], a["proj_y"] = acc, None, None, None
+        roix, roiy = a["roix"], a["roiy"]
+
+        def load_frame(i, n=n):
+            with self.profile(n, "load.read"):
+                img = load_tiff(i, n, self.exp, self.datdir, self.localdir)
+            if img is not None:
+                with self.profile(n, "load.threshold"):
+                    img -= self.detfac
+                    img[~np.logical_and(img > to, img < co)] = 0
+            return img
+
+        frames = range(acc["nf"], a["pnts"])
+        blocks = chunks(map_frames(load_frame, frames, self.io_workers))
+        for _, img in blocks:
+            with self.profile(n, "load.reduce"):
+                self._reduce(a, acc, img, use_distortion_corr)
+                a["total"] = add_total(a["total"], img)
+                crop = img[:, roiy[0] : roiy[1], roix[0] : roix[1]]
+                for k, proj in [("proj_y", crop.sum(axis=2)), ("proj_x", crop.sum(axis=1))]:
+                    a[k] = proj if a[k] is None else np.concatenate([a[k], proj])
+            self._say("\r#{0:<4} {1:<3}/{2:>3} ".format(n, acc["nf"], a["pnts"]), end="")
+        if len(frames):
+            self._say("" if acc["nf"] == a["pnts"] else "!!!")
+
+        a["nimg"] = acc["nf"]
+        if not a["nimg"]:
+            self._say("#{0:<4} -- no images".format(n))
+            a["img"] = None
+        else:
+            a["img"] = FrameReader(load_frame, a["nimg"], a["total"].frame_shape)
+        a["threshold"] = self.threshold
+        a["cutoff"] = self.cutoff
+        a["detfac"] = self.detfac
+        a["to"], a["co"] = to, co
+
+    def _say(self, text="", end="\n"):
+        """progress output of load, unless quiet"""
+        if not self.quiet:
+            sys.stdout.write(text + end)
+            sys.stdout.flush()
+
+    def column_shift(self, cols):
+        """sub-pixel vertical shift straightening the elastic line at detector columns"""
+        return column_shift(self.corr_poly, self.corr_y0, cols)
+
+    def distortion_map(self, roix, roiy, ny):
+        """gather map of the distortion correction for a ROI (built once per ROI)"""
+        key = (tuple(roix), tuple(roiy), ny)
+        if key not in self.corr_maps:
+            shift = self.column_shift(np.arange(roix[0], roix[1]))
+            rows = np.arange(roiy[0], roiy[1])
+            self.corr_maps[key] = distortion_map(shift, rows, ny)
+        return self.corr_maps[key]
+
+    def row_sums(self, img, roix, roiy, use_distortion_corr=True):
+        """
+        (frames, rows) sums along detector x inside the ROI of an image stack
+        - with distortion correction every frame is remapped through the
+          precomputed gather map of the curvature model
+        """
+        if isinstance(img, SparseStack):
+            shift = None
+            if use_distortion_corr and self.corr_poly is not None:
+                shift = self.column_shift(np.arange(roix[0], roix[1]))
+            return img.row_sums(roix, roiy, shift)
+        img = img[:, :, roix[0] : roix[1]]
+        if use_distortion_corr and self.corr_poly is not None:
+            return remap_sum(img, self.distortion_map(roix, roiy, img.shape[1]))
+        return np.sum(img[:, roiy[0] : roiy[1]], axis=2)
+
+    def _cache_params(self):
+        """parameters identifying a processed stack in the cache"""
+        return {
+            "threshold": self.threshold,
+            "cutoff": self.cutoff,
+            "detfac": self.detfac,
+            "bias_correct": False,
+            "detector": "andor",
+        }
+
+    def mirror(self, first=None, interval=5, prethreshold=None):
+        """
+        mirror new runs from datdir_remote to datdir_local in the background
+        - images are copied as they are collected, the .fio once a run is complete
+        - returns the running Mirror, stop it with .stop()
+
+        first -- first run to mirror (None: the run currently being collected)
+        interval -- seconds between polls of datdir_remote
+        prethreshold -- also threshold each completed run into the stack cache
+        - None: if the cache is enabled (and not streaming)
+        """
+        if prethreshold is None:
+            prethreshold = self.cache and not self.streaming
+        prepare = cache_worker(self, "load") if prethreshold else None
+        m = Mirror(self.exp, self.datdir, self.localdir, ["andor"], interval, first, prepare)
+        return m.start()
+
     def logbook(
         self,
         nstart=None,
@@ -254,6 +524,7 @@ class irixs:
     ):
         """
         tabulate runs
+        - metadata comes from the run index in datdir_local (see runindex.py)
         - shows if ring current was too low (SR_LIMIT)
         - shows if rixs_ener is different to dcm_ener
 
@@ -267,28 +538,20 @@ class irixs:
 
         if nstart:
             if nend is None:
-                try:
-                    latest = max(
-                        iglob(os.path.join(self.datdir, "*.fio")), key=os.path.getctime
-                    )
-                except ValueError:
+                latest = latest_run(self.exp, self.datdir)
+                if latest is None:
                     print("Using Local Directory")
-                    latest = max(
-                        iglob(os.path.join(self.localdir, "*.fio")),
-                        key=os.path.getctime,
-                    )
-                try:
-                    latest = latest[:-4].split("_")[-1]
-                    run_nos = range(nstart, int(latest) + 1)
-                except ValueError:
+                    latest = latest_run(self.exp, self.localdir)
+                if latest is None:
                     return
+                run_nos = range(nstart, latest + 1)
             else:
                 run_nos = range(nstart, nend + 1)
 
-        self.load(run_nos, False)
+        info = run_index(self.exp, run_nos, self.datdir, self.localdir)
         for run_no in run_nos:
             out = ""
-            a = self.runs[run_no]
+            a = info.get(run_no)
             if a is None:
                 continue
             try:
@@ -297,7 +560,7 @@ class irixs:
                 m1, m2, pnt, t = [float(c) for c in command[2:]]
             except IndexError:
                 continue
-            if np.any(a["data"]["sr_current"] < SR_LIMIT):
+            if a.get("sr_min", SR_LIMIT) < SR_LIMIT:
                 dump = "*"
             else:
                 dump = " "
@@ -359,7 +622,7 @@ class irixs:
         if not isinstance(run_nos, (list, tuple, range)):
             run_nos = [run_nos]
 
-        for run_no in run_nos:
+        for run_no in self.profile.each(run_nos, "detector"):
             a = self.runs[run_no]
             if a is None or a["img"] is None:
                 continue
@@ -381,33 +644,44 @@ class irixs:
             comV = []
             comH = []
 
-            imgarr = np.atleast_3d(np.array(a["img"]))
-            imtotal = np.nansum(imgarr, axis=0) / imgarr.shape[0]
-            imgarr = imgarr[:, roiy[0] : roiy[1], roix[0] : roix[1]]
+            # (frames, rows) and (frames, cols) projections of the ROI
+            if self.streaming:
+                imtotal = a["total"][0] / a["nimg"]
+                projy, projx = a["proj_y"], a["proj_x"]
+            else:
+                imgarr = a["img"]
+                if isinstance(imgarr, SparseStack):
+                    imtotal = imgarr.sum(axis=0) / imgarr.shape[0]
+                else:
+                    imtotal = np.nansum(imgarr, axis=0) / imgarr.shape[0]
+                imgarr = imgarr[:, roiy[0] : roiy[1], roix[0] : roix[1]]
+                projy = np.nansum(imgarr, axis=2)
+                projx = np.nansum(imgarr, axis=1)
 
-            if use_distortion_corr and self.corr_shift is not False:
-                for sh, (c1, c2) in zip(self.corr_shift, self.corr_regions):
-                    c1, c2 = c1 + roix[0], c2 + roix[0]
-                    imtotal[:, c1:c2] = np.roll(imtotal[:, c1:c2], sh, axis=0)
+            if use_distortion_corr and self.corr_poly is not None:
+                ny = imtotal.shape[0]
+                dmap = self.distortion_map(roix, [0, ny], ny)
+                imcorr = remap(imtotal[None, :, roix[0] : roix[1]], dmap)
+                imtotal[:, roix[0] : roix[1]] = imcorr[0]
 
             if oneshot:
                 x = np.arange(roiy[0], roiy[1])
-                y = np.nansum(imgarr, axis=(0, 2)) / imgarr.shape[0]
+                y = np.sum(projy, axis=0) / projy.shape[0]
             else:
                 for i, ef in enumerate(a["EF"]):
                     try:
-                        img = imgarr[i]
+                        py, px = projy[i], projx[i]
                     except IndexError:
                         continue
-                    yi = np.nansum(img)
+                    yi = np.sum(py)
                     xi = ef
                     x.append(xi)
                     y.append(yi)
                     if com:
                         rx = range(roiy[0], roiy[1])
                         ry = range(roix[0], roix[1])
-                        cv = np.nansum(rx * np.nansum(img, axis=1)) / yi
-                        ch = np.nansum(ry * np.nansum(img, axis=0)) / yi
+                        cv = np.nansum(rx * py) / yi
+                        ch = np.nansum(ry * px) / yi
                         comV.append(cv)
                         comH.append(ch)
                 x, y = np.array(x), np.array(y)
@@ -440,10 +714,12 @@ class irixs:
             else:
                 header += "{0:>24}{1:>24}".format(step, "roi-counts")
                 save_array = np.array([x, y]).T
-            np.savetxt(savefile, save_array, header=header)
+            with self.profile(run_no, "detector.save"):
+                np.savetxt(savefile, save_array, header=header)
 
             if fit:
-                a["xf"], a["yf"], a["p"] = peak_fit(x, y)
+                with self.profile(run_no, "detector.fit"):
+                    a["xf"], a["yf"], a["p"] = peak_fit(x, y)
                 report = "#{0:<4} (det)  ".format(run_no)
                 report += "cen:{0:.4f}   ".format(a["p"][2])
                 report += "amp:{0:.2f}   ".format(a["p"][0])
@@ -458,6 +734,10 @@ class irixs:
             a.pop("E0", None)
 
             if plot:
+                plt = pyplot()
+                from matplotlib.patches import Rectangle
+                from mpl_toolkits.axes_grid1 import make_axes_locatable
+
                 if com:
                     fig, ax = plt.subplots(
                         2, 2, constrained_layout=True, figsize=(8.5, 8)
@@ -555,7 +835,13 @@ class irixs:
                     plt.savefig(savename, dpi=300)
 
     def condition(
-        self, bins, run_nos, fit=False, use_distortion_corr=True, drop_beamdump=False
+        self,
+        bins,
+        run_nos,
+        fit=False,
+        use_distortion_corr=True,
+        drop_beamdump=False,
+        processes=None,
     ):
         """
         main data reduction routine, returns signal vs energy
@@ -563,20 +849,39 @@ class irixs:
         - elastic line set using y0 and E0 (E0 normally set by hrm_ener)
         - saves binned and unbinned datasets to file
         - reloads data before starting condition (which also update parameters if changed)
+        - for runs in progress only the newly arrived frames are processed
 
         bins -- 0 to disable binning, set in eV (float) or in array stride (integer)
+        - or an array of bin edges (in eV relative to E0) shared between runs
         runs -- numbers of runs
         - single value or list of runs
         - list of list will stitch runs under the first run number
         fit -- fit peak
         use_distortion_correction -- run calc_distortion to determine correction first
         drop_beamdump -- ignore runs measured during a beamdump
+        processes -- condition runs (and groups of stitched runs) in this many
+        worker processes (see batch.py), results are merged into self.runs
         """
-        self.load(run_nos)
+        if processes and processes > 1 and not isinstance(run_nos, int):
+            kwargs = {
+                "fit": fit,
+                "use_distortion_corr": use_distortion_corr,
+                "drop_beamdump": drop_beamdump,
+            }
+            jobs = [((bins, [g]), kwargs, flatten([g])) for g in run_nos]
+            runs = run_batch(self, "condition", jobs, processes)
+            if runs is not None:
+                for n, a in runs.items():
+                    self.runs[n] = a
+                    touch(self.lru, n)
+                return
+
+        self.load(run_nos, use_distortion_corr=use_distortion_corr)
         if isinstance(run_nos, int):
             run_nos = [run_nos]
+        binned = np.ndim(bins) > 0 or bool(bins)
 
-        for run_no in run_nos:
+        for run_no in self.profile.each(run_nos, "condition"):
 
             if isinstance(run_no, int):
                 run_no = [run_no]
@@ -591,51 +896,51 @@ class irixs:
                 ns.append(n)
 
                 roix, roiy, y0 = a["roix"], a["roiy"], a["y0"]
-                xinit = np.arange(roiy[0], roiy[1])
-                if self.photon_counting:
-                    xinit = np.tile(xinit, (roix[1] - roix[0], 1)).T
-
-                for ef, img, sr in zip(a["EF"], a["img"], a["data"]["sr_current"]):
+                use_corr = use_distortion_corr and self.corr_poly is not None
 
-                    if drop_beamdump and sr < SR_LIMIT:
-                        continue
+                nf = min(len(a["EF"]), a["nimg"])
+                ef = np.asarray(a["EF"][:nf])
+                acc = self.accumulate(a, nf, use_corr)
+                if drop_beamdump:
+                    keep = ~(a["data"]["sr_current"][:nf] < SR_LIMIT)
 
-                    img = deepcopy(img[:, roix[0] : roix[1]])
-
-                    if use_distortion_corr and self.corr_shift is not False:
-                        for sh, (c1, c2) in zip(self.corr_shift, self.corr_regions):
-                            img[:, c1:c2] = np.roll(img[:, c1:c2], sh, axis=0)
-
-                    img = img[roiy[0] : roiy[1]]
-                    if self.photon_counting:
-                        lbl, nlbl = scipy.ndimage.label(img)
-                        try:
-                            yi = scipy.ndimage.labeled_comprehension(
-                                img, lbl, range(1, nlbl + 1), np.sum, float, 0
-                            )
-                            xi = scipy.ndimage.labeled_comprehension(
-                                xinit, lbl, range(1, nlbl + 1), np.mean, float, 0
-                            )
-                            xi = (xi - y0) * pix_to_E(ef, self.dspacing) + ef
-                            xi = xi[yi > self.event_min]
-                            yi = yi[yi > self.event_min]
-                        except ValueError:
-                            pass
-                    else:
-                        yi = np.sum(img, axis=1)
-                        xi = (xinit - y0) * pix_to_E(ef, self.dspacing) + ef
-                    x.extend(xi)
-                    y.extend(yi)
-            if not x:
+                if self.photon_counting:
+                    ev = acc["ev"]
+                    sel = ev["sum"] > self.event_min
+                    if drop_beamdump:
+                        sel &= keep[ev["frame"]]
+                    ev = {k: v[sel] for k, v in ev.items()}
+                    ef = ef[ev["frame"]]
+                    yi = ev["sum"]
+                    xi = centroids(ev, self.centroid)
+                    if use_corr:  # straighten event positions directly
+                        xi = xi + self.column_shift(ev["col"])
+                    xi = (xi - y0) * pix_to_E(ef, self.dspacing) + ef
+                    x.append(xi)
+                    y.append(yi)
+                else:
+                    # (frames, rows) of summed intensity
+                    ef = ef[:, None]
+                    yi = acc["rows"]
+                    xi = np.arange(roiy[0], roiy[1])
+                    xi = (xi - y0) * pix_to_E(ef, self.dspacing) + ef
+                    if drop_beamdump:
+                        xi, yi = xi[keep], yi[keep]
+                    x.append(xi.ravel())
+                    y.append(yi.ravel())
+
+            parts = list(zip(x, y))
+            x = np.concatenate(x) if x else []
+            if not len(x):
                 continue
 
             n = ns[0]
             a = self.runs[n]
             a["label"] = ",".join([str(ni) for ni in ns])
 
-            x, y = np.array(x), np.array(y)
-            y = y[np.argsort(x)]
-            x = np.sort(x)
+            y = np.concatenate(y)
+            order = np.argsort(x)
+            x, y = x[order], y[order]
             if self.E0 is None:
                 en = a["dcm_ener"]  # EI incident energy
             else:
@@ -677,37 +982,48 @@ class irixs:
                 )
             else:
                 savefile = "{0}/{1}_{2:05d}.txt".format(self.savedir_dat, self.exp, n)
-            np.savetxt(
-                savefile,
-                np.array([x, y]).T,
-                header=header + "\n{0:>24}{1:>24}".format(a["auto"], "counts"),
-            )
+            with self.profile(n, "condition.save"):
+                np.savetxt(
+                    savefile,
+                    np.array([x, y]).T,
+                    header=header + "\n{0:>24}{1:>24}".format(a["auto"], "counts"),
+                )
 
-            y = y / self.photon_factor
-            if self.photon_counting and self.max_events:
-                x = np.delete(x, np.where(y > self.max_events + 0.5))
-                y = np.delete(y, np.where(y > self.max_events + 0.5))
-                for i in range(self.max_events, 1, -1):
-                    cnts = np.where(np.logical_and(y >= i - 0.5, y < i + 0.5))
-                    y[cnts] /= i
-                    if i > 2:
-                        y = np.append(y, np.tile(y[cnts], i - 1))
-                        x = np.append(x, np.tile(x[cnts], i - 1))
+            # bin the parts of each run directly, binned points are never sorted
+            parts = [(xi - en, yi / self.photon_factor) for xi, yi in parts]
+            split = self.photon_counting and self.max_events
+            if split:
+                parts = [split_events(xi, yi, self.max_events) for xi, yi in parts]
+            if binned:
+                with self.profile(n, "condition.bin"):
+                    if np.ndim(bins):
+                        edges = bins
                     else:
-                        y = np.append(y, y[cnts])
-                        x = np.append(x, x[cnts])
-                y = y[np.argsort(x)]
-                x = np.sort(x)
-            if bins:
-                x, y, e = binning(x, y, bins, self.photon_counting)
+                        lo = min(np.min(xi) for xi, _ in parts if len(xi))
+                        hi = max(np.max(xi) for xi, _ in parts if len(xi))
+                        edges = bin_edges(bins, lo, hi, sum(len(xi) for xi, _ in parts))
+                    acc = bin_init(edges)
+                    for xi, yi in parts:
+                        bin_add(acc, xi, yi)
+                    x, y, e = bin_result(acc, self.photon_counting)
             else:
+                if split:
+                    x = np.concatenate([xi for xi, _ in parts])
+                    y = np.concatenate([yi for _, yi in parts])
+                    order = np.argsort(x)
+                    x, y = x[order], y[order]
+                else:
+                    y = y / self.photon_factor
                 e = np.sqrt(y)
             y[~np.isfinite(y)] = 0
             a["x"], a["y"], a["e"] = x, y, e
 
             if fit:
-                a["xf"], a["yf"], a["p"] = peak_fit(x, y)
-                report = "#{0:<4} (bin: {1})  ".format(n, bins)
+                with self.profile(n, "condition.fit"):
+                    a["xf"], a["yf"], a["p"] = peak_fit(x, y)
+                report = "#{0:<4} (bin: {1})  ".format(
+                    n, "edges" if np.ndim(bins) else bins
+                )
                 report += "cen:{0:8.4f}   ".format(a["p"][2])
                 report += "amp:{0:6.2f}   ".format(a["p"][0])
                 report += "fwhm:{0:6.3f}   ".format(a["p"][1] * 2)
@@ -717,9 +1033,18 @@ class irixs:
             else:
                 a["p"] = False
 
-            header += "bin_size: {0}\n".format(bins)
+            if np.ndim(bins):
+                header += "bin_edges: {0} to {1} ({2} bins)\n".format(
+                    edges[0], edges[-1], len(edges) - 1
+                )
+            else:
+                header += "bin_size: {0}\n".format(bins)
             header += "\n{0:>24}{1:>24}{2:>24}".format(a["auto"], "counts", "stderr")
-            if bins < 5:
+            if np.ndim(bins):
+                savefile = "{0}/{1}_{2:05d}_b{3}edges.txt".format(
+                    self.savedir_con, self.exp, n, len(bins)
+                )
+            elif bins < 5:
                 savefile = "{0}/{1}_{2:05d}_b{3:.1f}meV.txt".format(
                     self.savedir_con, self.exp, n, bins * 1000
                 )
@@ -727,7 +1052,8 @@ class irixs:
                 savefile = "{0}/{1}_{2:05d}_b{3}.txt".format(
                     self.savedir_con, self.exp, n, bins
                 )
-            np.savetxt(savefile, np.array([x, y, e]).T, header=header)
+            with self.profile(n, "condition.save"):
+                np.savetxt(savefile, np.array([x, y, e]).T, header=header)
 
     def plot(
         self,
@@ -774,6 +1100,7 @@ class irixs:
             if not isinstance(labels, (list, tuple)):
                 labels = [labels]
 
+        plt = pyplot()
         if ax is None:
             _, ax = plt.subplots(figsize=(6, 5), constrained_layout=True)
         if cmap:
@@ -952,6 +1279,9 @@ class irixs:
         to = a["threshold"] - a["detfac"]
         co = a["cutoff"] - a["detfac"]
 
+        plt = pyplot()
+        import scipy.ndimage
+
         i = {}
         i["idx"] = no
         fig, i["ax"] = plt.subplots()
@@ -1014,8 +1344,27 @@ class irixs:
         fig.canvas.mpl_connect("key_press_event", press)
 
     def calc_distortion(
-        self, run_no, slices=8, oneshot=True, no=0, plot=False, vmin=0, vmax=10
+        self,
+        run_no,
+        slices=8,
+        order=2,
+        oneshot=True,
+        no=0,
+        plot=False,
+        vmin=0,
+        vmax=10,
     ):
+        """
+        model the curvature of the elastic line for the distortion correction
+        - fits the line centre in vertical slices of the detector ROI
+        - a polynomial in x through the slice centres gives a sub-pixel shift
+          for every detector column, applied in detector and condition
+
+        run_no -- run with a strong elastic line
+        slices -- number of vertical slices to fit
+        order -- order of the polynomial curvature model
+        oneshot -- use all images summed together, otherwise image no
+        """
 
         self.load(run_no)
         a = self.runs[run_no]
@@ -1023,9 +1372,10 @@ class irixs:
             print("detector images not loaded")
             return
 
-        if oneshot:
-            img = np.atleast_3d(np.array(a["img"]))
-            img = np.sum(img, axis=0)
+        if oneshot and self.streaming:
+            img = a["total"][0]
+        elif oneshot:
+            img = np.sum(a["img"], axis=0)
         else:
             img = a["img"][no]
         img = img[self.roiy[0] : self.roiy[1], self.roix[0] : self.roix[1]]
@@ -1033,38 +1383,36 @@ class irixs:
         y = np.sum(img, axis=1)
         x = np.arange(self.roiy[0], self.roiy[1])
         _, _, pinit = peak_fit(x, y)
-        y0 = int(round(pinit[2]))
-        print("fitted y0: {}".format(y0))
+        y0 = pinit[2]
+        print("fitted y0: {}".format(int(round(y0))))
         print("initial fwhm: {:.4f}".format(pinit[1] * 2))
 
         slice_width = img.shape[1] / slices
-        shift = []
-        regions = []
-
-        for i in range(slices):
-            c1, c2 = int(i * slice_width), int(i * slice_width + slice_width)
-            yi = np.sum(img[:, c1:c2], axis=1)
-            try:
-                _, _, pi = peak_fit(x, yi)
-                cen = int(round(pi[2]))
-            except RuntimeError:
-                cen = y0
-            shift.append(y0 - cen)
-            regions.append([c1, c2])
+        regions = [
+            [int(i * slice_width), int(i * slice_width + slice_width)]
+            for i in range(slices)
+        ]
+        # all slices in one batch, failed fits are left out
+        yi = np.array([np.sum(img[:, c1:c2], axis=1) for c1, c2 in regions])
+        pi = peak_fit_batch(x, yi)
+        fitted = np.isfinite(pi).all(axis=1)
+        cols = self.roix[0] + (np.sum(regions, axis=1) - 1) / 2
+        cols, cens = cols[fitted], pi[fitted, 2]
 
-        self.corr_shift = shift
-        self.corr_regions = regions
+        self.corr_poly = fit_curvature(cols, cens, order)
+        self.corr_y0 = y0
+        self.corr_maps = {}
 
-        imgcorr = deepcopy(img)
-        for sh, (c1, c2) in zip(shift, regions):
-            yi = np.sum(imgcorr[:, c1:c2], axis=1)
-            imgcorr[:, c1:c2] = np.roll(imgcorr[:, c1:c2], sh, axis=0)
+        h = img.shape[0]
+        shift = self.column_shift(np.arange(self.roix[0], self.roix[1]))
+        imgcorr = remap(img[None], distortion_map(shift, np.arange(h), h))[0]
 
         ycorr = np.sum(imgcorr, axis=1)
         _, _, pfinal = peak_fit(x, ycorr)
         print("final fwhm: {:.4f}".format(pfinal[1] * 2))
 
         if plot:
+            plt = pyplot()
             _, ax = plt.subplots(1, 3, figsize=(10, 4), constrained_layout=True)
             ax[0].plot(x, y, lw=0.5)
             ax[0].plot(x, ycorr, lw=0.5)
@@ -1093,6 +1441,9 @@ class irixs:
 
             ax[1].axhline(y0, color="#F012BE", lw=0.5)
             ax[2].axhline(y0, color="#F012BE", lw=0.5)
-            for sh, (c1, c2) in zip(shift, regions):
+            xc = np.arange(self.roix[0], self.roix[1])
+            ax[1].plot(xc, np.polyval(self.corr_poly, xc), color="#0074D9", lw=0.5)
+            ax[1].plot(cols, cens, ".", color="#0074D9")
+            for c1, c2 in regions:
                 ax[1].axvline(c1 + self.roix[0], color="#F012BE", lw=0.5)
                 ax[2].axvline(c1 + self.roix[0], color="#F012BE", lw=0.5)
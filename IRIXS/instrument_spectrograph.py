@@ -5,13 +5,22 @@ import sys
 import shutil
 import copy
 import numpy as np
-import matplotlib.pyplot as plt
 
-from glob import glob, iglob
-from tabulate import tabulate
-from matplotlib.offsetbox import AnchoredText
+from glob import glob
 
-from .tools import load_fio, load_tiff, flatten, peak_fit, binning
+from .tools import load_fio, load_tiff, flatten, binning, pyplot
+from .tools import peak_fit, peak_fit_batch, peak_curve
+from .tools import alloc_stack, grow_stack, map_frames, tiff_index
+from .tools import bias_correct_4output, BIAS_SAMPLES
+from .cache import cache_path, source_signature, load_cache, save_cache
+from .cache import touch, evict_images
+from .runindex import run_index, latest_run
+from .mirror import Mirror, cache_worker
+from .batch import run_batch
+from .profiling import Profiler
+from .sparse import SparseStack, convert_stack
+from .stream import FrameReader, chunks, CHUNK
+from .events import find_events, centroids
 
 
 class spectrograph:
@@ -33,6 +42,12 @@ class spectrograph:
         datdir_remote="/gpfs/current/raw",
         datdir_local="raw",
         savedir="processed",
+        io_workers=4,
+        cache=True,
+        sparse=False,
+        streaming=False,
+        max_cache_bytes=None,
+        profile=None,
     ):
 
         # if ROI is not given, use detector limits
@@ -61,6 +76,15 @@ class spectrograph:
         self.datdir = datdir_remote
         self.localdir = datdir_local
         self.savedir = savedir
+        self.io_workers = io_workers  # threads loading tiffs (1 to disable)
+        self.cache = cache  # keep thresholded stacks in datdir_local/cache
+        self.sparse = sparse  # store only nonzero pixels (see sparse.py)
+        self.streaming = streaming  # project images while loading, keep no stack
+        self.max_cache_bytes = max_cache_bytes  # memory budget for images (LRU)
+        self.lru = {}  # run numbers, least recently used first
+        self.quiet = False  # no progress output from extract (see mirror.cache_worker)
+        # time, bytes read and peak memory per run and stage (see profiling.py)
+        self.profile = Profiler(profile)  # None: if IRIXS_PROFILE is set
 
         os.makedirs(self.localdir, exist_ok=True)
         os.makedirs(self.savedir, exist_ok=True)
@@ -71,6 +95,14 @@ class spectrograph:
         """ Extract run data and information
         Imports detector tiff images and run information from fio files.
         Applies the threshold and cutoff.
+        Images are stored in a contiguous (pnts, ny, nx) stack,
+        or with sparse=True as a SparseStack of the nonzero pixels.
+        Completed runs are read from / written to the local stack cache.
+        For runs in progress only newly arrived images are loaded.
+        With streaming=True images are projected (see transform) as they are
+        loaded and not kept, a["img"] reads them back from disk on demand.
+        With max_cache_bytes, images of the least recently used runs are
+        dropped afterwards (and reloaded when needed again).
 
         -- run_nos : single run number or list of run numbers
         """
@@ -83,20 +115,39 @@ class spectrograph:
             if n not in self.runs.keys():
                 self.runs[n] = None
 
-        for run_no in run_nos:
-            if self.runs[run_no] and self.runs[run_no]["complete"]:
-                continue
+        for run_no in self.profile.each(run_nos, "extract"):
+            b = self.runs[run_no]
+            if b and b["complete"]:
+                touch(self.lru, run_no)
+                if "img" in b:
+                    continue
 
             fio_file = "{0}_{1:05d}.fio".format(self.exp, run_no)
             fio_remote = os.path.join(self.datdir, fio_file)
             fio_local = os.path.join(self.localdir, fio_file)
 
-            if not os.path.isfile(fio_local):
+            if b and b["complete"]:
+                a = b  # images were evicted, metadata and results are kept
+            elif not os.path.isfile(fio_local):
                 a = load_fio(run_no, self.exp, self.datdir)
                 if a and a["complete"]:
                     shutil.copyfile(fio_remote, fio_local)
             else:
                 a = load_fio(run_no, self.exp, self.localdir)
+            if a:
+                touch(self.lru, run_no)
+
+            cache = None
+            if self.cache and a and a["complete"] and not self.streaming:
+                cache = cache_path(
+                    self.localdir, self.exp, run_no, self.detector_type
+                )
+                source = self._cache_source(run_no)
+                stack = load_cache(cache, self._cache_params(), source)
+                if stack is not None:
+                    a["img"] = convert_stack(stack, len(stack), self.sparse)
+                    self.runs[run_no] = a
+                    continue
 
             # default to remote folder if it exists
             if os.path.exists(self.datdir):
@@ -106,42 +157,182 @@ class spectrograph:
             img_folder = f"{self.exp}_{run_no:05d}"
             img_folder = os.path.join(img_root, img_folder, self.detector_type)
 
-            # find image files and sort by collection time
+            # find image files and sort by collection time, local copies
+            # by frame number (they are not necessarily copied in order)
             filepaths = glob(os.path.join(img_folder, "*.tiff"))
-            filepaths = sorted(filepaths, key=os.path.getctime)
+            order = os.path.getctime if img_root == self.datdir else tiff_index
+            filepaths = sorted(filepaths, key=order)
             filenames = [os.path.basename(f) for f in filepaths]
 
-            img_list = []
-            for i, f in enumerate(filenames):
-                img = load_tiff(
-                    f,
-                    run_no,
-                    self.exp,
-                    self.datdir,
-                    self.localdir,
-                    self.bias_correct,
-                    self.detector_type,
-                )
-                if img is None:
-                    break
-                img -= self.detfac
-                bounds = (img > self.threshold) & (img < self.cutoff)
-                img[~bounds] = 0
-                img_list.append(img)
-                sys.stdout.write(
-                    "\r#{0:<4} {1:<3}/{2:>3} ".format(run_no, i+1, a["pnts"])
-                )
-            if not img_list:
-                print(f"#{run_no:<4} -- no images loaded")
+            def load_frame(f, run_no=run_no):
+                with self.profile(run_no, "extract.read"):
+                    return load_tiff(
+                        f,
+                        run_no,
+                        self.exp,
+                        self.datdir,
+                        self.localdir,
+                        detector=self.detector_type,
+                    )
+
+            if self.streaming:
+                self._stream(run_no, a, filenames, load_frame)
                 continue
-            if a["pnts"] != len(img_list):
-                print("!!!")
+
+            # keep the images (and transform) of a run still in progress
+            b = self.runs[run_no]
+            if b and "stack" in b and b["params"] == self._cache_params():
+                stack, nimg = b["stack"], len(b["img"])
+                stack = convert_stack(stack, nimg, self.sparse)
+                if self.sparse:
+                    stack.truncate(nimg)
+                else:
+                    stack = grow_stack(stack, len(filenames))
+                if "trans" in b:
+                    a["trans"] = b["trans"]
             else:
-                print()
-            a["img"] = img_list
+                stack, nimg = None, 0
+
+            # frames are bias corrected and thresholded in blocks, a dense
+            # stack takes the raw frames and is prepared in place
+            frames = map_frames(load_frame, filenames[nimg:], self.io_workers)
+            if self.sparse:
+                frames = chunks(frames)
+            start = nimg
+            for img in frames:
+                if self.sparse:
+                    img = self._prepare(run_no, img[1])
+                    if stack is None:
+                        stack = SparseStack(img.shape[1:], img.dtype)
+                    for frame in img:
+                        stack[nimg] = frame
+                        nimg += 1
+                else:
+                    if img is None:
+                        break
+                    if stack is None:
+                        stack = alloc_stack(len(filenames), img)
+                    stack[nimg] = img
+                    nimg += 1
+                    if nimg - start == CHUNK:
+                        self._prepare(run_no, stack[start:nimg])
+                        start = nimg
+                self._say(
+                    "\r#{0:<4} {1:<3}/{2:>3} ".format(run_no, nimg, a["pnts"]), end=""
+                )
+            if not self.sparse and nimg > start:
+                self._prepare(run_no, stack[start:nimg])
+            if not nimg:
+                self._say(f"#{run_no:<4} -- no images loaded")
+                continue
+            self._say("!!!" if a["pnts"] != nimg else "")
+            a["img"] = stack[:nimg]
+            a["stack"], a["params"] = stack, self._cache_params()
             self.runs[run_no] = a
 
-    def transform(self, run_nos, ysca=1, fit=True):
+            if cache and a["pnts"] == nimg:
+                with self.profile(run_no, "extract.cache"):
+                    source = self._cache_source(run_no)
+                    save_cache(cache, a["img"], self._cache_params(), source)
+
+        evict_images(self.runs, self.lru, self.max_cache_bytes, keep=run_nos)
+
+    def _stream(self, run_no, a, filenames, load_frame):
+        """
+        streaming extract: images are projected in small blocks as they are loaded
+        - continues the projections of a run in progress
+        - the ROI images themselves (a["imgr"]) are not kept
+        """
+        b = self.runs[run_no]
+        key = self._trans_key(1)
+        t = None
+        if b and b.get("params") == self._cache_params():
+            t = b.get("trans")
+        if t is None or t["key"] != key:
+            t = self._trans_init(key, keep_roi=False)
+
+        x = a["data"][a["auto"]]
+        todo = filenames[t["n"] : len(x)]
+        for _, img in chunks(map_frames(load_frame, todo, self.io_workers)):
+            self._prepare(run_no, img)
+            n = t["n"] + len(img)
+            with self.profile(run_no, "extract.project"):
+                self._project(t, img, x[t["n"] : n])
+            t["n"], t["shape"] = n, img.shape[1:]
+            self._say(
+                "\r#{0:<4} {1:<3}/{2:>3} ".format(run_no, n, a["pnts"]), end=""
+            )
+        if not t["n"]:
+            self._say(f"#{run_no:<4} -- no images loaded")
+            return
+        if todo:
+            self._say("!!!" if a["pnts"] != t["n"] else "")
+
+        a["trans"], a["params"] = t, self._cache_params()
+
+        def read_frame(i):
+            img = load_frame(filenames[i])
+            return None if img is None else self._prepare(run_no, img[None])[0]
+
+        a["img"] = FrameReader(read_frame, t["n"], t["shape"])
+        self.runs[run_no] = a
+
+    def _say(self, text="", end="\n"):
+        """progress output of extract, unless quiet"""
+        if not self.quiet:
+            sys.stdout.write(text + end)
+            sys.stdout.flush()
+
+    def _prepare(self, run_no, img):
+        """
+        bias correct (greateyes) and threshold a (frames, ny, nx) block of
+        loaded frames in place
+        """
+        if self.bias_correct:
+            with self.profile(run_no, "extract.bias"):
+                bias_correct_4output(img)
+        with self.profile(run_no, "extract.threshold"):
+            img -= self.detfac
+            bounds = (img > self.threshold) & (img < self.cutoff)
+            img[~bounds] = 0
+        return img
+
+    def _cache_params(self):
+        """parameters identifying a processed stack in the cache"""
+        return {
+            "threshold": self.threshold,
+            "cutoff": self.cutoff,
+            "detfac": self.detfac,
+            "bias_correct": self.bias_correct,
+            "bias_samples": BIAS_SAMPLES if self.bias_correct else None,
+            "detector": self.detector_type,
+        }
+
+    def mirror(self, first=None, interval=5, prethreshold=None):
+        """ Mirror new runs from datdir_remote to datdir_local in the background
+        Images are copied as they are collected, the fio file once a run is
+        complete. Returns the running Mirror, stop it with .stop()
+
+        -- first : first run to mirror (None: the run currently being collected)
+        -- interval : seconds between polls of datdir_remote
+        -- prethreshold : also threshold each completed run into the stack cache
+            (None: if the cache is enabled and not streaming)
+        """
+        if prethreshold is None:
+            prethreshold = self.cache and not self.streaming
+        prepare = cache_worker(self, "extract") if prethreshold else None
+        m = Mirror(
+            self.exp, self.datdir, self.localdir, [self.detector_type],
+            interval, first, prepare,
+        )
+        return m.start()
+
+    def _cache_source(self, run_no):
+        return source_signature(
+            run_no, self.exp, self.datdir, self.localdir, self.detector_type
+        )
+
+    def transform(self, run_nos, ysca=1, fit=True, processes=None):
         """ Transforms detector images into an array
         Applies defined ROI and stores summed intensity
         Stores the summed intensity along detector X (horiz) and Y (vert) axes
@@ -149,78 +340,84 @@ class spectrograph:
         -- run_nos : single run number or list of run numbers
         -- ysca : intensity scaling factor
         -- fit : if True, attempt to fit summed X and Y intensities
+        -- processes : transform runs in this many worker processes
+                       (see batch.py), results are merged into self.runs
+
+        For runs in progress only newly arrived images are transformed.
         """
 
-        self.extract(run_nos)
         if not isinstance(run_nos, (list, tuple, range)):
             run_nos = [run_nos]
 
-        for run_no in run_nos:
+        if processes and processes > 1:
+            kwargs = {"ysca": ysca, "fit": fit}
+            jobs = [(([g],), kwargs, flatten([g])) for g in run_nos]
+            runs = run_batch(self, "transform", jobs, processes)
+            if runs is not None:
+                for n, a in runs.items():
+                    self.runs[n] = a
+                    touch(self.lru, n)
+                return
+
+        self.extract(run_nos)
+
+        for run_no in self.profile.each(run_nos, "transform"):
 
             # sum up images if given a list of run_nos
             if isinstance(run_no, (list, tuple)):
                 a = self.runs[run_no[0]]
-                img = np.atleast_3d(np.array(a["img"])) / len(run_no)
+                img = np.asarray(a["img"]) / len(run_no)
                 for r in run_no[1:]:
-                    b = self.runs[r]
-                    img = img + np.atleast_3d(np.array(b["img"])) / len(run_no)
+                    img += np.asarray(self.runs[r]["img"]) / len(run_no)
             # single image
             else:
                 a = self.runs[run_no]
-                img = np.atleast_3d(np.array(a["img"]))
-                img = img * ysca
+                img = a["img"]
+                if ysca != 1:
+                    img = np.asarray(img) * ysca
 
             x = a["data"][a["auto"]]
             if len(x) != len(img):
                 x = x[:img.shape[0]]
 
-            y, roi, imgr = [], [], []
-            rx, ry, imgx, imgy = [], [], [], []
-
-            for im, xi in zip(img, x):
-                try:
-                    rc = self.roic(xi)  # roi centre defined by a function
-                except TypeError:
-                    rc = self.roic  # fixed value
-                roiy = rc - (self.roih//2), rc+(self.roih//2)
-                roi.append([self.roix[0], self.roix[1], roiy[0], roiy[1]])
-
-                ri = im[roiy[0]:roiy[1], self.roix[0]:self.roix[1]]
-                imgr.append(ri)
-                y.append(np.nansum(ri))
-
-                rx.append(np.arange(roiy[0], roiy[1]))
-                ry.append(np.arange(self.roix[0], self.roix[1]))
+            # frames transformed by a previous call are reused (runs in progress)
+            key = self._trans_key(ysca)
+            t = None if isinstance(run_no, (list, tuple)) else a.get("trans")
+            if t is None or t["key"] != key or t["n"] > len(x):
+                t = self._trans_init(key, keep_roi=not self.streaming)
+                if not isinstance(run_no, (list, tuple)):
+                    a["trans"] = t
 
-                imgx.append(np.nansum(ri, axis=1))
-                imgy.append(np.nansum(ri, axis=0))
+            if len(x) > t["n"]:
+                with self.profile(run_no, "transform.project"):
+                    self._project(t, img, x[t["n"]:], t["n"])
+            t["n"] = len(x)
 
-            y = np.array(y)
+            y, roi, imgr = t["y"], t["roi"], t.get("imgr")
+            rx, ry, imgx, imgy = t["rx"], t["ry"], t["imgx"], t["imgy"]
 
-            r1 = min(i[0] for i in roi)
-            r2 = max(i[1] for i in roi)
-            r3 = min(i[2] for i in roi)
-            r4 = max(i[3] for i in roi)
+            r1, r3 = int(roi[:, 0].min()), int(roi[:, 2].min())
+            r2, r4 = int(roi[:, 1].max()), int(roi[:, 3].max())
             x_totx = np.arange(r3, r4)
             x_toty = np.arange(r1, r2)
 
-            imgroi = np.atleast_3d(np.array(imgr))
-            tot = np.nansum(imgroi, axis=0) / img.shape[0]
+            tot = np.atleast_2d(t["tot"]) / img.shape[0]
             totx = np.nansum(tot, axis=1)
             toty = np.nansum(tot, axis=0)
 
             f_txt = "fwhm: {0:.4f}\ncen: {1:.1f}\namp: {2:.1f}\nfra: {3:.1f}"
             if fit:
                 try:
-                    xfx, yfx, px = peak_fit(x_totx, totx)
-                    xfy, yfy, py = peak_fit(x_toty, toty)
+                    with self.profile(run_no, "transform.fit"):
+                        xfx, yfx, px = peak_fit(x_totx, totx)
+                        xfy, yfy, py = peak_fit(x_toty, toty)
                     txtx = f_txt.format(px[1]*2, px[2], px[0], px[3])
                     txty = f_txt.format(py[1]*2, py[2], py[0], py[3])
                 except:
                     fit = False
 
             a["x"], a["y"] = x, y
-            a["roi"], a["imgr"] = roi, imgroi
+            a["roi"], a["imgr"] = roi, imgr
             a["rx"], a["ry"], a["imgx"], a["imgy"] = rx, ry, imgx, imgy
             a["extent"] = [r1, r2, r3, r4]
             a["tot"], a["totx"], a["toty"] = tot, totx, toty
@@ -231,6 +428,123 @@ class spectrograph:
                 a["xfx"], a["yfx"], a["px"], a["txtx"] = xfx, yfx, px, txtx
                 a["xfy"], a["yfy"], a["py"], a["txty"] = xfy, yfy, py, txty
 
+    def _trans_key(self, ysca):
+        """
+        parameters the transform accumulator of a run depends on, the
+        thresholds too: it outlives the images when they are evicted
+        """
+        return (
+            tuple(self.roix), self.roih, self.roic, ysca,
+            self.threshold, self.cutoff, self.detfac,
+        )
+
+    def _trans_init(self, key, keep_roi=True):
+        """
+        empty transform accumulator, per-frame results are kept as
+        (frames, ...) arrays: y, roi, rx, ry, imgx, imgy (and imgr)
+        """
+        t = {"key": key, "n": 0, "tot": 0}
+        for k in ["y", "roi", "rx", "ry", "imgx", "imgy"] + ["imgr"] * keep_roi:
+            t[k] = None
+        return t
+
+    def _project(self, t, img, x, start=0):
+        """
+        add ROI sums and projections of frames start.. of img (scan positions x)
+        - a fixed roic is a single slice of the stack, with a roic(x) function
+          the ROI rows of each frame are gathered into a zero padded
+          (frames, rows, cols) block (rows outside the detector stay zero)
+        """
+        n, h = len(x), 2 * (self.roih // 2)
+        c1, c2 = self.roix
+        fixed = not callable(self.roic)
+        if fixed:
+            rc = np.full(n, self.roic, dtype=int)
+        else:  # roi centre defined by a function
+            rc = np.array([self.roic(xi) for xi in x], dtype=int)
+        r1 = rc - self.roih // 2
+        rows = r1[:, None] + np.arange(h)
+
+        # ROI images are kept as copies, a view would hold on to the whole
+        # stack (a temporary one when scaled or summed over runs)
+        keep = "imgr" in t
+        if not fixed:
+            ny = img.shape[1]
+            dtype = getattr(img, "dtype", None) or np.asarray(img[start]).dtype
+            imgr = np.empty((n if keep else min(n, CHUNK), h, c2 - c1), dtype)
+
+        parts = {"imgx": [], "imgy": [], "imgr": []}
+        for f in range(0, n, CHUNK):
+            k = min(CHUNK, n - f)
+            if fixed:
+                ri = img[start + f : start + f + k, r1[0] : r1[0] + h, c1:c2]
+                if keep:
+                    parts["imgr"].append(ri)
+            else:
+                ri = imgr[f : f + k] if keep else imgr[:k]
+                for j, r in enumerate(r1[f : f + k]):
+                    lo, hi = min(max(r, 0), r + h), max(min(r + h, ny), r)
+                    ri[j, : lo - r] = 0
+                    ri[j, hi - r :] = 0
+                    ri[j, lo - r : hi - r] = img[start + f + j, lo:hi, c1:c2]
+            parts["imgx"].append(np.nansum(ri, axis=2))
+            parts["imgy"].append(np.nansum(ri, axis=1))
+            t["tot"] = t["tot"] + np.nansum(ri, axis=0)
+
+        if keep and not fixed:
+            parts["imgr"] = [imgr]
+        new = {k: np.concatenate(v) for k, v in parts.items() if v}
+        new["y"] = new["imgx"].sum(axis=1)
+        new["roi"] = np.c_[np.tile(self.roix, (n, 1)), r1, r1 + h]
+        new["rx"] = rows
+        new["ry"] = np.tile(np.arange(c1, c2), (n, 1))
+        for k, v in new.items():
+            t[k] = v if t[k] is None else np.concatenate([t[k], v])
+
+    def centroid(self, run_nos, event_min=0, mode="com", subpixel=4):
+        """ Photon centroiding of detector events inside the ROI
+        Labels contiguous events in all images of a run in one pass and
+        locates each event with sub-pixel precision. Stores the events and
+        their intensity histograms along detector X and Y in 1/subpixel bins
+        (averaged per image, as totx and toty).
+
+        -- run_nos : single run number or list of run numbers
+        -- event_min : minimum summed intensity of an event
+        -- mode : "com" intensity-weighted centroid, "eta" adds eta correction,
+                  "mean" unweighted mean pixel position
+        -- subpixel : number of histogram bins per detector pixel
+        """
+
+        self.extract(run_nos)
+        if not isinstance(run_nos, (list, tuple, range)):
+            run_nos = [run_nos]
+
+        for run_no in flatten(run_nos):
+            a = self.runs[run_no]
+            if a is None:
+                continue
+            if "extent" not in a:
+                self.transform(run_no, fit=False)
+            r1, r2, r3, r4 = a["extent"]
+
+            ev = find_events(a["img"][:, r3:r4, r1:r2], r3, r1)
+            sel = ev["sum"] > event_min
+            ev = {k: v[sel] for k, v in ev.items()}
+            ev["x"] = centroids(ev, mode, "row")
+            ev["y"] = centroids(ev, mode, "col")
+
+            # pixel k covers k-0.5 .. k+0.5
+            nimg = len(a["img"])
+            for ax, lo, hi in [("x", r3, r4), ("y", r1, r2)]:
+                edges = np.arange(lo * subpixel, hi * subpixel + 1) / subpixel - 0.5
+                hist, _ = np.histogram(ev[ax], bins=edges, weights=ev["sum"])
+                a["cen_" + ax] = (edges[1:] + edges[:-1]) / 2
+                a["cen_tot" + ax] = hist / nimg
+
+            a["events"] = ev
+            a["cen_mode"] = mode
+            print(f"#{run_no:<4} {len(ev['sum'])} events")
+
     def detector(self, run_no):
         """ plot raw features of the detector signal
         interactively step through individual images
@@ -242,6 +556,9 @@ class spectrograph:
             self.transform(run_no)
         a = self.runs[run_no]
 
+        plt = pyplot()
+        from matplotlib.offsetbox import AnchoredText
+
         fig = plt.figure(figsize=(16.5, 8.5))
         gs0 = fig.add_gridspec(
             1, 2, left=0.05, right=0.99, top=0.99, bottom=0.04,
@@ -386,7 +703,9 @@ class spectrograph:
         oneshot_no=None,
         fit=False,
         xsca=1,
-        x0=0
+        x0=0,
+        centroid=False,
+        processes=None,
     ):
         """ Load, bin and save experiment run data to file.
         By default loads ROI intensity as a function of scanning motor
@@ -399,20 +718,29 @@ class spectrograph:
         -- fit : if True, attempt to fit a pseudo-voight profile to data
         -- xsca : x-axis scaling factor
         -- x0 : x-xaxis offset value  / x = (x - x0) * xsca
+        -- centroid : if True, oneshot summation uses the sub-pixel event
+                      histograms from centroid()
+        -- processes : load and transform the runs in this many worker
+                       processes (see transform)
         """
 
         if not isinstance(run_nos, (list, tuple, range)):
             run_nos = [run_nos]
 
-        self.transform(run_nos)
+        self.transform(run_nos, processes=processes)
 
-        for run_no in run_nos:
+        for run_no in self.profile.each(run_nos, "condition"):
             if "x" not in self.runs[run_no]:
                 self.transform(run_no)
             a = self.runs[run_no]
+            if centroid and "events" not in a:
+                self.centroid(run_no)
 
             if oneshot_x:
-                if oneshot_no:
+                if centroid:
+                    x = a["cen_x"]
+                    y = a["cen_totx"]
+                elif oneshot_no:
                     x = a["rx"][oneshot_no]
                     y = a["imgx"][oneshot_no]
                 else:
@@ -420,7 +748,10 @@ class spectrograph:
                     y = a["totx"]
                 a["cond_type"] = "oneshot_x"
             elif oneshot_y:
-                if oneshot_no:
+                if centroid:
+                    x = a["cen_y"]
+                    y = a["cen_toty"]
+                elif oneshot_no:
                     x = a["ry"][oneshot_no]
                     y = a["imgy"][oneshot_no]
                 else:
@@ -440,7 +771,8 @@ class spectrograph:
 
         if fit:
             try:
-                xf, yf, p = peak_fit(x, y)
+                with self.profile(a["no"], "condition.fit"):
+                    xf, yf, p = peak_fit(x, y)
                 r = "#{0}  ".format(a["no"])
                 r += "cen:{0:.4f}   ".format(p[2])
                 r += "amp:{0:.2f}   ".format(p[0])
@@ -460,12 +792,13 @@ class spectrograph:
             header += "      x-pixel       intensity"
         else:
             header += f"{a['auto']}    Intensity"
-        np.savetxt(
-            os.path.join(self.savedir, f"{self.exp}_{a['no']}_b{bins}.dat"),
-            np.array([x, y]).T,
-            fmt="% .8e",
-            header=header
-        )
+        with self.profile(a["no"], "condition.save"):
+            np.savetxt(
+                os.path.join(self.savedir, f"{self.exp}_{a['no']}_b{bins}.dat"),
+                np.array([x, y]).T,
+                fmt="% .8e",
+                header=header
+            )
 
     def plot(
         self,
@@ -484,6 +817,7 @@ class spectrograph:
             run_nos = [run_nos]
 
         if not ax:
+            plt = pyplot()
             if plot_trend:
                 fig = plt.figure(figsize=(7, 9), constrained_layout=True)
                 gs = fig.add_gridspec(2, 3, height_ratios=[0.8, 1.0])
@@ -578,38 +912,34 @@ class spectrograph:
             txt_title += f" {title}: {a[title]}"
 
         if plot:
+            plt = pyplot()
             _, ax = plt.subplots(figsize=(6, 7), constrained_layout=True)
             ax.text(0.04, 0.98, txt_title, transform=ax.transAxes)
 
-        trend_x0, trend_I, trend_fw = [], [], []
+        curves, lines = [], []
         for i, (x, y, xpos) in enumerate(zip(r, im, a["x"])):
 
             if bins:
                 x, y, _ = binning(x, y, bins)
+            curves.append((x, y))
 
             if plot:
-                l, = ax.plot(x, y+i*ystep, lw=0.75)
+                lines += ax.plot(x, y+i*ystep, lw=0.75)
                 ax.text(x[0], y[0]+i*ystep, f"{xpos:.4f}", fontsize="small")
 
-            if fit:
-                try:
-                    xf, yf, p = peak_fit(x, y)
-                    if plot:
+        if fit:  # all images in one batch
+            p = peak_fit_batch([c[0] for c in curves], [c[1] for c in curves])
+            if plot:
+                for i, ((x, _), pi, l) in enumerate(zip(curves, p, lines)):
+                    if np.isfinite(pi).all():
+                        xf, yf = peak_curve(x, pi)
                         ax.plot(xf, yf+i*ystep, color=l.get_color(), lw=0.5)
-
-                    if (p[1] < maxsig) and (p[2] > 0):
-                        trend_I.append(p[0])
-                        trend_x0.append(p[2])
-                        trend_fw.append(p[1] * 2)
-                    else:
-                        trend_I.append(np.nan)
-                        trend_x0.append(np.nan)
-                        trend_fw.append(np.nan)    
-                except:
-                    trend_I.append(np.nan)
-                    trend_x0.append(np.nan)
-                    trend_fw.append(np.nan)
-            else:
+            with np.errstate(invalid="ignore"):
+                p[~((p[:, 1] < maxsig) & (p[:, 2] > 0))] = np.nan
+            trend_I, trend_x0, trend_fw = p[:, 0], p[:, 2], p[:, 1] * 2
+        else:
+            trend_x0, trend_I, trend_fw = [], [], []
+            for x, y in curves:
                 com = np.sum(x * y)/np.sum(y)
                 height = np.max(y) - np.min(y)
                 half = x[np.abs(y - (height / 2 + np.min(y))).argmin()]
@@ -621,6 +951,7 @@ class spectrograph:
         trend_x = a["x"]
 
         if plot_trend:
+            plt = pyplot()
             _, ax = plt.subplots(
                 1, 3, constrained_layout=True, figsize=(8, 4)
             )
@@ -643,6 +974,8 @@ class spectrograph:
             trend_x0,
             trend_fw
         ]).T
+        from tabulate import tabulate
+
         print(txt_title)
         print(tabulate(
             results,
@@ -660,33 +993,26 @@ class spectrograph:
     ):
         """
         display list of experiment runs
+        (metadata from the run index in datdir_local, see runindex.py)
         -- nstart, nend : range of run numbers
         -- date : show date and time of run
         """
 
         if nstart:
             if nend is None:
-                try:
-                    latest = max(
-                        iglob(os.path.join(self.datdir, "*.fio")),
-                        key=os.path.getctime
-                    )
-                except ValueError:  # remote directory not present
+                latest = latest_run(self.exp, self.datdir)
+                if latest is None:  # remote directory not present
                     print("Using Local Directory")
-                    latest = max(
-                        iglob(os.path.join(self.localdir, "*.fio")),
-                        key=os.path.getctime,
-                    )
-                try:
-                    latest = latest[:-4].split("_")[-1]
-                    run_nos = range(nstart, int(latest) + 1)
-                except ValueError:
+                    latest = latest_run(self.exp, self.localdir)
+                if latest is None:
                     return
+                run_nos = range(nstart, latest + 1)
             else:
                 run_nos = range(nstart, nend + 1)
 
+        info = run_index(self.exp, run_nos, self.datdir, self.localdir)
         for run_no in run_nos:
-            a = load_fio(run_no, self.exp, self.datdir)
+            a = info.get(run_no)
             if a is None:
                 continue
             cmd_txt = " ".join(a["command"])
@@ -0,0 +1,253 @@
+""" background mirror of new runs from the remote to the local data directory
+
+During a beamtime the first look at a run otherwise pays the remote (GPFS)
+latency for every image. A Mirror polls datdir for the runs of an
+experiment and copies them to localdir while the scans are still running:
+
+- images are mirrored as they appear, through load_tiff (only complete,
+  decodable files are copied, in collection order)
+- the .fio file is copied once the run is complete, as load/extract do
+- optionally each completed run is handed to prepare(run), e.g. to fill
+  the local stack cache with thresholded images (see cache_worker)
+
+Start it from an instrument (irixs.mirror, spectrograph.mirror) or run
+the irixs_mirror console script next to the analysis session.
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import threading
+
+from copy import copy
+
+from .tools import load_fio, load_tiff, flush_mirror
+from .profiling import Profiler
+
+
+class Mirror:
+    def __init__(
+        self,
+        exp,
+        datdir,
+        localdir,
+        detectors=("andor",),
+        interval=5,
+        first=None,
+        prepare=None,
+    ):
+        """
+        exp -- experiment filename prefix
+        datdir -- remote data directory to watch
+        localdir -- local data directory to mirror to
+        detectors -- image folders of each run to mirror
+        interval -- seconds between polls of datdir
+        first -- first run to mirror (None: the latest run when started)
+        prepare -- optional callable(run) for each run once it is mirrored
+        """
+        self.exp = exp
+        self.datdir = datdir
+        self.localdir = localdir
+        self.detectors = list(detectors)
+        self.interval = interval
+        self.first = first
+        self.prepare = prepare
+
+        self.done = set()  # runs completely mirrored
+        self.copied = {}  # (run, detector): names of the mirrored images
+        self._stop = threading.Event()
+        self._thread = None
+
+    def pending(self):
+        """runs with a .fio in datdir that are not mirrored yet (single listing)"""
+        prefix = self.exp + "_"
+        try:
+            names = os.listdir(self.datdir)
+        except OSError:
+            return []
+        runs = []
+        for f in names:
+            if f.startswith(prefix) and f.endswith(".fio"):
+                try:
+                    runs.append(int(f[len(prefix) : -4]))
+                except ValueError:
+                    pass
+        if self.first is None:
+            self.first = max(runs, default=0)
+        return sorted(n for n in runs if n >= self.first and n not in self.done)
+
+    def sync_images(self, run, detector):
+        """mirror the images of run that arrived since the last poll"""
+        folder = "{0}_{1:05d}".format(self.exp, run)
+        remote = os.path.join(self.datdir, folder, detector)
+        try:
+            names = [f for f in os.listdir(remote) if f.endswith(".tiff")]
+        except OSError:
+            return True
+        have = self.copied.get((run, detector))
+        if have is None:
+            try:
+                local = os.listdir(os.path.join(self.localdir, folder, detector))
+            except OSError:
+                local = []
+            have = self.copied[(run, detector)] = set(local)
+
+        # in collection order
+        new = sorted(
+            (f for f in names if f not in have),
+            key=lambda f: os.path.getctime(os.path.join(remote, f)),
+        )
+        for f in new:
+            img = load_tiff(f, run, self.exp, self.datdir, self.localdir, detector=detector)
+            if img is None:  # still being written, try again next poll
+                return False
+            have.add(f)
+        return True
+
+    def sync_run(self, run):
+        """mirror what there is of run, returns True once it is complete locally"""
+        a = load_fio(run, self.exp, self.datdir)
+        if a is None:
+            return False
+        synced = all([self.sync_images(run, d) for d in self.detectors])
+        if not (synced and a["complete"]):
+            return False
+        flush_mirror()
+        fio = "{0}_{1:05d}.fio".format(self.exp, run)
+        path_local = os.path.join(self.localdir, fio)
+        if not os.path.isfile(path_local):
+            os.makedirs(self.localdir, exist_ok=True)
+            shutil.copyfile(os.path.join(self.datdir, fio), path_local)
+        for d in self.detectors:
+            self.copied.pop((run, d), None)
+        return True
+
+    def scan(self):
+        """one pass over datdir, returns the runs completed in this pass"""
+        completed = []
+        for run in self.pending():
+            if self._stop.is_set():
+                break
+            if self.sync_run(run):
+                self.done.add(run)
+                completed.append(run)
+                if self.prepare:
+                    self.prepare(run)
+        return completed
+
+    def _poll(self):
+        while not self._stop.is_set():
+            try:
+                self.scan()
+            except Exception as e:  # keep mirroring, e.g. after a network hiccup
+                print("mirror: {}".format(e), file=sys.stderr)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """start polling in a background (daemon) thread"""
+        if self._thread and self._thread.is_alive():
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._poll, name="irixs-mirror", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """stop polling, waits for the current run to finish copying"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        flush_mirror()
+
+    @property
+    def running(self):
+        return bool(self._thread and self._thread.is_alive())
+
+
+def cache_worker(inst, method):
+    """
+    prepare callable for a Mirror that fills the stack cache of each run
+    - uses a private copy of the instrument (irixs with "load",
+      spectrograph with "extract"), so the interactive session is untouched
+    - works quietly (the copy has quiet set, no progress output), a run
+      that fails is reported in one line on stderr
+    - the images are dropped again once they are cached
+    """
+    worker = copy(inst)
+    worker.streaming = False
+    worker.max_cache_bytes = None
+    worker.profile = Profiler(False)
+    worker.quiet = True
+
+    def prepare(run):
+        try:
+            worker.runs, worker.lru = {}, {}
+            getattr(worker, method)([run])
+        except Exception as e:
+            print("mirror: caching #{} failed ({!r})".format(run, e), file=sys.stderr)
+        finally:
+            worker.runs, worker.lru = {}, {}
+
+    return prepare
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="irixs_mirror",
+        description="mirror new runs from the remote to the local data directory",
+    )
+    parser.add_argument("exp", help="experiment filename prefix")
+    parser.add_argument("--remote", default="/gpfs/current/raw", help="remote data directory")
+    parser.add_argument("--local", default="raw", help="local data directory")
+    parser.add_argument(
+        "--detector", action="append", help="image folder to mirror (repeatable, default andor)"
+    )
+    parser.add_argument("--first", type=int, help="first run to mirror (default: latest)")
+    parser.add_argument("--interval", type=float, default=5, help="seconds between polls")
+    parser.add_argument("--once", action="store_true", help="single pass, then exit")
+    parser.add_argument(
+        "--cache",
+        choices=["irixs", "spectrograph"],
+        help="also threshold completed runs into the local stack cache",
+    )
+    parser.add_argument("--threshold", type=int)
+    parser.add_argument("--cutoff", type=int)
+    parser.add_argument("--detfac", type=int)
+    args = parser.parse_args()
+
+    detectors = args.detector or ["andor"]
+    prepare = None
+    if args.cache:
+        kw = {"datdir_remote": args.remote, "datdir_local": args.local}
+        for k in ["threshold", "cutoff", "detfac"]:
+            if getattr(args, k) is not None:
+                kw[k] = getattr(args, k)
+        if args.cache == "irixs":
+            from .instrument_rowland import irixs
+
+            prepare = cache_worker(irixs(args.exp, **kw), "load")
+        else:
+            from .instrument_spectrograph import spectrograph
+
+            kw["detector_type"] = detectors[0]
+            prepare = cache_worker(spectrograph(args.exp, **kw), "extract")
+
+    m = Mirror(args.exp, args.remote, args.local, detectors, args.interval, args.first, prepare)
+    if args.once:
+        m.first = 1 if args.first is None else args.first
+        print("mirrored: {}".format(m.scan()))
+        flush_mirror()
+        return
+    print("mirroring {} from {} to {} (ctrl-c to stop)".format(args.exp, args.remote, args.local))
+    m.start()
+    try:
+        while m.running:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        m.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -18,6 +18,8 @@ from mpl_toolkits.axes_grid1 import make_axes_locatable
 
 from matplotlib.pyplot import imread
 
+from .tools import map_frames, read_fio_data
+
 plt.rcParams['xtick.top'] = True
 plt.rcParams['ytick.right'] = True
 plt.rcParams['font.size'] = 8
@@ -59,29 +61,9 @@ def peak_fit(x, y):
 def load_fio(run, exp, datdir):
     path = '{0}/{1}_{2:05d}.fio'.format(datdir, exp, run)
     a = {}
-    head = []
-    data = []
     with open(path) as f:
-        for line in f:
-            l = line.strip()
-            if line.startswith('%d'):
-                break
-        for line in f:
-            l = line.strip().split()
-            if not l:
-                break
-            if l[0] == 'Col':
-                head.append(l[2])
-            else:
-                try:
-                    data.append([float(x) for x in l])
-                except ValueError:
-                    break
-    if head and data:
-        data = [x for x in data if x]
-        data = np.array(data)
-        data = data.view(dtype=[(n, float) for n in head])
-        data = data.reshape(len(data))
+        head, data, _ = read_fio_data(f)
+    if head and data is not None:
         a['data'] = data
         a['auto'] = head[0]
         a['pnts'] = data.shape[0]
@@ -102,7 +84,15 @@ def load_tiff(run, exp, datdir, no, indicator=True):
     return img
 
 
-def load(run, exp, datdir, detfac, to, co):
+def load(run, exp, datdir, detfac, to, co, io_workers=4):
+
+    def load_frame(i):
+        img = load_tiff(run, exp, datdir, i)
+        if img is not None:
+            img -= detfac
+            img[~np.logical_and(img > to, img < co)] = 0
+        return img
+
     a = load_fio(run, exp, datdir)
     imgtest = load_tiff(run, exp, datdir, 0, indicator=False)
     if imgtest is None:
@@ -110,23 +100,21 @@ def load(run, exp, datdir, detfac, to, co):
     else:
         a['img'] = []
     print('#{} ({} points)'.format(run, a['pnts']), end=' ')
-    for i,_ in enumerate(a['data'][a['auto']]):
-        if i > len(a['img'])-1:
-            img = load_tiff(run, exp, datdir, i)
-            if img is not None:
-                img -= detfac
-                img[~np.logical_and(img > to, img < co)] = 0
-                a['img'].append(img)
+    frames = range(len(a['img']), a['pnts'])
+    for img in map_frames(load_frame, frames, io_workers):
+        if img is not None:
+            a['img'].append(img)
     print()
     return a
 
 
-def detector(run, exp, datdir, vmax=10, threshold=1010, cutoff=1800, detfac=935):
+def detector(run, exp, datdir, vmax=10, threshold=1010, cutoff=1800, detfac=935,
+             io_workers=4):
 
     to = threshold - detfac
     co = cutoff - detfac
 
-    a = load(run, exp, datdir, detfac, to, co)
+    a = load(run, exp, datdir, detfac, to, co, io_workers)
     if a is None:
         return
 
@@ -45,10 +45,11 @@ from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.widgets import Cursor, RectangleSelector
 from matplotlib.offsetbox import AnchoredText
 from os.path import basename, splitext
-from scipy.optimize import least_squares
 from datetime import datetime as dt
 from copy import deepcopy
 
+from .tools import read_fio_data
+
 progname = "P01-PLOT"
 
 REMOTE = False
@@ -213,6 +214,8 @@ def peak_fit(x, y, deriv=False):
         return [amplitude, sigma, centre, bgnd, frac]
 
     # least squares fit
+    from scipy.optimize import least_squares
+
     p0 = init_params(x, y)
     p = least_squares(errfunc, p0, args=(x, y), bounds=bounds)
 
@@ -586,9 +589,6 @@ class ApplicationWindow(QtWidgets.QMainWindow):
         self.pop_block = False
 
     def load_fio(self, path):
-        head = []
-        data = []
-        complete = False
         with open(path) as f:
 
             if nonblockread:
@@ -617,36 +617,13 @@ class ApplicationWindow(QtWidgets.QMainWindow):
                 else:
                     p, v = line.split(" = ")
                     try:
-                        a[p] = np.float(v[:-1])
+                        a[p] = float(v[:-1])
                     except:
                         a[p] = v[:-1]
-            for line in f:
-                if line[:-1] == "%d":
-                    break
-            for line in f:
-                if line.startswith("! Acquisition ended"):
-                    complete = True
-                    break
-                elif not line[:-1]:
-                    break
-                l = line[:-1].split()
-                if l[0] == "Col":
-                    head.append(l[2])
-                else:
-                    data.append(l)
-
-        if head and data:
-            try:
-                data = np.asarray(data, dtype=np.float)
-            except ValueError:
-                try:
-                    data = np.asarray(data[:-1], dtype=np.float)
-                except ValueError:
-                    return False, False
+            head, data, complete = read_fio_data(f)
 
+        if head and data is not None:
             pnts = data.shape[0]
-            data = data.view(dtype=[(n, np.float) for n in head])
-            data = data.reshape(pnts)
             a["data"] = data
             a["auto"] = head[0]
             a["pnts"] = pnts
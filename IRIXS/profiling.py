@@ -0,0 +1,167 @@
+""" opt-in stage timing of the reduction (profile=True or IRIXS_PROFILE=1)
+
+A Profiler keeps, for every run, a record of each stage it went through:
+
+    load, condition, detector          irixs
+    extract, transform, condition      spectrograph
+
+with wall time, number of calls, bytes read from .fio/.tiff files and
+peak traced memory (tracemalloc) while the stage ran. Finer sub-stages
+are recorded as "<stage>.<step>" with time and calls only:
+
+    load.fio                           .fio metadata (also bytes and memory)
+    load.read, load.threshold          tiff read + decode, threshold/cutoff
+    condition.reduce                   ROI row sums or photon event labelling
+    condition.bin, .fit, .save         binning, peak fit, np.savetxt
+    ...
+
+Sub-stages running in the io_workers threads (read, threshold) add up the
+time of all threads, so they can exceed the wall time of their stage.
+
+    a = irixs(exp, ..., profile=True)
+    a.condition(0.01, runs)
+    print(a.profile)                   # table
+    a.profile.report()                 # {run: {stage: {...}}} to log
+
+Disabled (the default), every hook is a no-op. Enabled, tracemalloc slows
+down allocation heavy steps, compare timings of profiled runs only.
+"""
+
+import os
+import time
+import threading
+import tracemalloc
+
+from contextlib import nullcontext
+
+from .tools import io_counting, bytes_read
+
+ENV_VAR = "IRIXS_PROFILE"
+
+_NULL = nullcontext()
+
+
+def _run_key(n):
+    # groups of runs (stitched, summed) are recorded under their first run
+    while isinstance(n, (list, tuple, range)):
+        n = n[0]
+    return n
+
+
+class _Stage:
+    def __init__(self, prof, run, name, memory):
+        self.prof, self.run, self.name, self.memory = prof, run, name, memory
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        if self.memory:
+            self.b0 = bytes_read()
+            stack = self.prof._stack
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:  # keep the peak reached so far by the enclosing stage
+                stack[-1].top = max(stack[-1].top, peak)
+            self.base = self.top = current
+            tracemalloc.reset_peak()
+            stack.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        dt = time.perf_counter() - self.t0
+        if not self.memory:
+            self.prof.add(self.run, self.name, dt)
+            return
+        top = max(self.top, tracemalloc.get_traced_memory()[1])
+        stack = self.prof._stack
+        stack.pop()
+        if stack:
+            stack[-1].top = max(stack[-1].top, top)
+        self.prof.add(self.run, self.name, dt, bytes_read() - self.b0, top - self.base)
+
+
+class Profiler:
+    def __init__(self, enabled=None):
+        """
+        enabled -- record stages, None: if the IRIXS_PROFILE environment
+        variable is set (and not 0)
+        """
+        if enabled is None:
+            enabled = os.environ.get(ENV_VAR, "0") not in ("", "0")
+        self.enabled = bool(enabled)
+        self.runs = {}
+        self._stack = []
+        self._lock = threading.Lock()
+        if self.enabled:
+            io_counting(True)
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+    def __call__(self, run, name):
+        """context manager timing a sub-stage (e.g. "condition.bin") of run"""
+        if not self.enabled:
+            return _NULL
+        return _Stage(self, _run_key(run), name, False)
+
+    def stage(self, run, name):
+        """context manager recording a stage of run (time, bytes read, peak memory)"""
+        if not self.enabled:
+            return _NULL
+        return _Stage(self, _run_key(run), name, True)
+
+    def each(self, runs, name):
+        """iterate over runs, recording each iteration as a stage of that run"""
+        if not self.enabled:
+            yield from runs
+            return
+        for n in runs:
+            with self.stage(n, name):
+                yield n
+
+    def add(self, run, name, seconds, nbytes=0, peak=0, calls=1):
+        """add a record of stage name to run"""
+        with self._lock:
+            r = self.runs.setdefault(run, {}).setdefault(
+                name, {"time": 0.0, "calls": 0, "bytes": 0, "peak": 0}
+            )
+            r["time"] += seconds
+            r["calls"] += calls
+            r["bytes"] += nbytes
+            r["peak"] = max(r["peak"], peak)
+
+    def merge(self, runs):
+        """add the records of another profiler (e.g. of a batch worker)"""
+        for n, stages in runs.items():
+            for k, v in stages.items():
+                self.add(n, k, v["time"], v["bytes"], v["peak"], v["calls"])
+
+    def report(self, run_nos=None):
+        """{run: {stage: {time, calls, bytes, peak}}} (copies), all runs by default"""
+        if run_nos is None:
+            run_nos = sorted(self.runs, key=str)
+        elif not isinstance(run_nos, (list, tuple, range)):
+            run_nos = [run_nos]
+        return {
+            n: {k: dict(v) for k, v in self.runs[n].items()}
+            for n in run_nos
+            if n in self.runs
+        }
+
+    def reset(self):
+        self.runs = {}
+
+    def __getstate__(self):
+        # sent to a worker process: settings only, the worker records its own runs
+        return {"enabled": self.enabled}
+
+    def __setstate__(self, state):
+        self.__init__(state["enabled"])
+
+    def __str__(self):
+        lines = ["{0:<6}{1:<24}{2:>10}{3:>7}{4:>12}{5:>12}".format(
+            "run", "stage", "seconds", "calls", "MB read", "peak MB"
+        )]
+        for n, stages in self.report().items():
+            for k, v in sorted(stages.items()):
+                lines.append("{0:<6}{1:<24}{2:>10.3f}{3:>7}{4:>12.1f}{5:>12.1f}".format(
+                    str(n), k, v["time"], v["calls"], v["bytes"] / 1e6, v["peak"] / 1e6
+                ))
+        return "\n".join(lines)
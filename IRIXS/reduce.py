@@ -0,0 +1,151 @@
+""" irixs_reduce: headless batch reduction described by a config file
+
+Runs load/condition for a list of run groups without any figures (Agg
+backend), spread over worker processes, and writes the usual dat/, con/
+(or processed/) outputs plus a timing summary. The config is YAML, JSON
+or TOML (by file extension):
+
+    instrument: irixs          # or spectrograph
+    exp: exp
+    processes: 8               # worker processes (see batch.py)
+    parameters:                # keyword arguments of the instrument
+      y0: 1024
+      roix: [0, 2048]
+      roih: [-200, 200]
+      threshold: 1010
+      cutoff: 1800
+      datdir_remote: /gpfs/current/raw
+    distortion:                # optional, irixs.calc_distortion arguments
+      run_no: 4
+    condition:                 # one entry per condition call
+      - bins: 0.01
+        runs: [1, [2, 3], 5]
+      - bins: 0.005
+        runs: [7, 8]
+        fit: true
+
+Each condition entry takes the keyword arguments of irixs.condition or
+spectrograph.condition, with runs for run_nos.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+TIMING_FILE = "reduce_timing.txt"
+
+
+def read_config(path):
+    """config dict from a .yaml/.yml, .json or .toml file"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in [".yaml", ".yml"]:
+        try:
+            import yaml
+        except ImportError:
+            sys.exit("irixs_reduce: reading {} needs PyYAML".format(path))
+        with open(path) as f:
+            return yaml.safe_load(f)
+    if ext == ".toml":
+        try:
+            import tomllib
+        except ImportError:  # python < 3.11
+            try:
+                import tomli as tomllib
+            except ImportError:
+                sys.exit("irixs_reduce: reading {} needs tomli".format(path))
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    with open(path) as f:
+        return json.load(f)
+
+
+def _int_keys(d):
+    # run numbers as dict keys (e.g. y0 per run) arrive as strings from JSON/TOML
+    return {int(k): v for k, v in d.items()}
+
+
+def reduce(config, processes=None):
+    """
+    run the reduction described by a config dict (see module docstring)
+    returns the timing summary as a list of (step, runs, seconds)
+    """
+    from .instrument_rowland import irixs
+    from .instrument_spectrograph import spectrograph
+
+    kind = config.get("instrument", "irixs")
+    params = dict(config.get("parameters", {}))
+    if isinstance(params.get("y0"), dict):
+        params["y0"] = _int_keys(params["y0"])
+    if processes is None:
+        processes = config.get("processes")
+
+    timing = []
+    t = time.perf_counter()
+    if kind == "irixs":
+        inst = irixs(config["exp"], **params)
+    elif kind == "spectrograph":
+        inst = spectrograph(config["exp"], **params)
+    else:
+        sys.exit("irixs_reduce: unknown instrument {}".format(kind))
+    timing.append(("setup", "", time.perf_counter() - t))
+
+    if config.get("distortion"):
+        if kind != "irixs":
+            sys.exit("irixs_reduce: distortion correction needs instrument irixs")
+        t = time.perf_counter()
+        inst.calc_distortion(**config["distortion"])
+        timing.append(
+            ("distortion", config["distortion"]["run_no"], time.perf_counter() - t)
+        )
+
+    for step in config.get("condition", []):
+        kw = dict(step)
+        runs = kw.pop("runs")
+        kw.setdefault("processes", processes)
+        t = time.perf_counter()
+        if kind == "irixs":
+            inst.condition(kw.pop("bins", 0), runs, **kw)
+            name = "condition (bins: {})".format(step.get("bins", 0))
+        else:
+            inst.condition(runs, **kw)
+            name = "condition (bins: {})".format(step.get("bins"))
+        timing.append((name, json.dumps(runs), time.perf_counter() - t))
+
+    return timing
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="irixs_reduce",
+        description="headless batch reduction described by a YAML/JSON/TOML config",
+    )
+    parser.add_argument("config", help="reduction config file")
+    parser.add_argument("--processes", type=int, help="worker processes (overrides config)")
+    args = parser.parse_args()
+
+    # no figures: select Agg before any plotting, also for worker processes
+    os.environ["MPLBACKEND"] = "Agg"
+    import matplotlib
+
+    matplotlib.use("Agg")
+
+    config = read_config(args.config)
+    t = time.perf_counter()
+    timing = reduce(config, args.processes)
+    timing.append(("total", "", time.perf_counter() - t))
+
+    from tabulate import tabulate
+
+    summary = tabulate(
+        [(s, r, "{:.2f}".format(dt)) for s, r, dt in timing],
+        headers=["step", "runs", "seconds"],
+    )
+    print("\n" + summary)
+    with open(TIMING_FILE, "w") as f:
+        f.write("config: {}\n\n{}\n".format(os.path.abspath(args.config), summary))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+""" persistent index of run metadata for logbooks and run discovery
+
+The summary of every .fio file (header parameters, command, date, scan
+averages, lowest ring current, completeness) is kept in a small SQLite
+database in the local data directory. A file is only parsed again if its
+size or modification time changed, and completed runs are not even
+checked, so tabulating thousands of runs does not touch the data blocks.
+"""
+
+import os
+import json
+import sqlite3
+import numpy as np
+
+from .tools import load_fio
+
+INDEX_FILE = "runindex.sqlite"
+
+
+def _connect(localdir):
+    if localdir:
+        os.makedirs(localdir, exist_ok=True)
+        path = os.path.join(localdir, INDEX_FILE)
+    else:
+        path = ":memory:"
+    con = sqlite3.connect(path)
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS runs (exp TEXT, run INTEGER, mtime INTEGER,"
+        " size INTEGER, complete INTEGER, info TEXT, PRIMARY KEY (exp, run))"
+    )
+    return con
+
+
+def summary(a):
+    """json-able metadata of a run loaded by load_fio (everything but the data)"""
+    info = {}
+    for k, v in a.items():
+        if isinstance(v, (np.floating, np.integer, np.bool_)):
+            v = v.item()
+        if isinstance(v, (str, int, float, bool, list)):
+            info[k] = v
+    if "sr_current" in a["data"].dtype.names:
+        info["sr_min"] = float(np.min(a["data"]["sr_current"]))
+    return info
+
+
+def latest_run(exp, *dirs):
+    """
+    highest run number of exp with a .fio file
+    - uses the first directory that has any, from a single listing (no stat)
+    """
+    prefix = exp + "_"
+    for d in dirs:
+        try:
+            names = os.listdir(d)
+        except (OSError, TypeError):
+            continue
+        runs = []
+        for f in names:
+            if f.startswith(prefix) and f.endswith(".fio"):
+                try:
+                    runs.append(int(f[len(prefix) : -4]))
+                except ValueError:
+                    pass
+        if runs:
+            return max(runs)
+
+
+def run_index(exp, run_nos, datdir, localdir):
+    """
+    metadata of runs as dicts (see summary), runs without a .fio are left out
+    - read from the index in localdir, (re)parsing only new or changed files
+    - the local copy of a .fio is used if present
+    """
+    con = _connect(localdir)
+    known = {}
+    for run, mtime, size, complete, info in con.execute(
+        "SELECT run, mtime, size, complete, info FROM runs WHERE exp = ?", (exp,)
+    ):
+        known[run] = (mtime, size, complete, info)
+
+    out = {}
+    with con:
+        for n in run_nos:
+            k = known.get(n)
+            if k and k[2]:  # completed runs do not change any more
+                out[n] = json.loads(k[3])
+                continue
+            fio = "{0}_{1:05d}.fio".format(exp, n)
+            for d in [localdir, datdir]:
+                if not d:
+                    continue
+                try:
+                    st = os.stat(os.path.join(d, fio))
+                    break
+                except OSError:
+                    continue
+            else:
+                continue
+            if k and k[:2] == (st.st_mtime_ns, st.st_size):
+                out[n] = json.loads(k[3])
+                continue
+            a = load_fio(n, exp, d)
+            if a is None:
+                continue
+            info = summary(a)
+            con.execute(
+                "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?)",
+                (exp, n, st.st_mtime_ns, st.st_size, int(a["complete"]), json.dumps(info)),
+            )
+            out[n] = info
+    con.close()
+    return out
@@ -0,0 +1,209 @@
+""" sparse storage of thresholded detector image stacks
+
+After threshold and cutoff almost every detector pixel is zero. A
+SparseStack keeps only the surviving pixels (row, col, value) of each
+frame, concatenated over the whole stack, with ptr marking where each
+frame starts. It behaves like the dense (frames, ny, nx) stack where the
+reduction code needs it:
+
+    len(stack), stack.shape         number of frames, dense shape
+    stack[i]                        dense frame
+    stack[i:j]                      sparse stack of frames i..j (no copy)
+    stack[f, r1:r2, c1:c2]          dense crop (e.g. a ROI)
+    np.sum(stack, axis=0)           summed image
+    np.asarray(stack)               dense stack
+
+row_sums gives ROI projections in time proportional to the number of
+stored pixels.
+"""
+
+import numpy as np
+
+
+class SparseStack:
+    def __init__(self, frame_shape, dtype):
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        idx = np.uint16 if max(self.frame_shape) < 2 ** 16 else np.int32
+        self.rows = np.zeros(0, dtype=idx)
+        self.cols = np.zeros(0, dtype=idx)
+        self.vals = np.zeros(0, dtype=self.dtype)
+        self.ptr = np.zeros(1, dtype=np.int64)
+
+    @classmethod
+    def from_dense(cls, img):
+        """sparse copy of a dense (frames, ny, nx) stack"""
+        img = np.asarray(img)
+        stack = cls(img.shape[1:], img.dtype)
+        for im in img:
+            stack.append(im)
+        return stack
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """rebuild a stack stored with arrays() (e.g. from the cache)"""
+        stack = cls(arrays["frame_shape"], arrays["vals"].dtype)
+        for k in ["rows", "cols", "vals", "ptr"]:
+            setattr(stack, k, np.asarray(arrays[k]))
+        return stack
+
+    def arrays(self):
+        """compact arrays describing the stack (for np.savez)"""
+        p0, p1 = self.ptr[0], self.ptr[-1]
+        return {
+            "frame_shape": np.array(self.frame_shape),
+            "rows": self.rows[p0:p1],
+            "cols": self.cols[p0:p1],
+            "vals": self.vals[p0:p1],
+            "ptr": self.ptr - p0,
+        }
+
+    def __len__(self):
+        return len(self.ptr) - 1
+
+    @property
+    def shape(self):
+        return (len(self),) + self.frame_shape
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def nbytes(self):
+        n = self.ptr[-1] - self.ptr[0]
+        size = self.rows.itemsize + self.cols.itemsize + self.vals.itemsize
+        return int(n * size + self.ptr.nbytes)
+
+    def append(self, img):
+        """add a thresholded frame, only its nonzero pixels are kept"""
+        if img.shape != self.frame_shape:
+            raise ValueError("frame shape {} != {}".format(img.shape, self.frame_shape))
+        r, c = np.nonzero(img)
+        p0, p1 = self.ptr[-1], self.ptr[-1] + len(r)
+        if p1 > len(self.vals):
+            # grow storage by at least doubling, as grow_stack
+            size = max(p1, 2 * len(self.vals))
+            for k in ["rows", "cols", "vals"]:
+                old = getattr(self, k)
+                new = np.zeros(size, dtype=old.dtype)
+                new[: len(old)] = old
+                setattr(self, k, new)
+        self.rows[p0:p1], self.cols[p0:p1], self.vals[p0:p1] = r, c, img[r, c]
+        self.ptr = np.append(self.ptr, p1)
+
+    def truncate(self, n):
+        """drop all frames from n onwards"""
+        self.ptr = self.ptr[: n + 1]
+
+    def __setitem__(self, i, img):
+        # frames arrive in order, as in the dense preallocated stack
+        if i != len(self):
+            raise IndexError("sparse stacks only append frames in order")
+        self.append(img)
+
+    def _frames(self, f):
+        """frame range (start, stop) of an int or slice index"""
+        n = len(self)
+        if isinstance(f, slice):
+            start, stop, step = f.indices(n)
+            if step != 1:
+                raise IndexError("sparse stacks only support contiguous frames")
+            return start, max(start, stop)
+        f = int(f)
+        if f < 0:
+            f += n
+        if not 0 <= f < n:
+            raise IndexError("frame {} out of range".format(f))
+        return f, f + 1
+
+    def _view(self, start, stop):
+        view = SparseStack.__new__(SparseStack)
+        view.__dict__.update(self.__dict__)
+        view.ptr = self.ptr[start : stop + 1]
+        return view
+
+    def _pixels(self, start, stop):
+        """frame index, row, col and value of every stored pixel of frames start..stop"""
+        p0, p1 = self.ptr[start], self.ptr[stop]
+        frame = np.repeat(np.arange(stop - start), np.diff(self.ptr[start : stop + 1]))
+        return frame, self.rows[p0:p1], self.cols[p0:p1], self.vals[p0:p1]
+
+    def crop(self, frames, rows, cols):
+        """dense (frames, rows, cols) block, rows and cols as [start, stop]"""
+        start, stop = self._frames(frames)
+        f, r, c, v = self._pixels(start, stop)
+        inside = (r >= rows[0]) & (r < rows[1]) & (c >= cols[0]) & (c < cols[1])
+        out = np.zeros((stop - start, rows[1] - rows[0], cols[1] - cols[0]), self.dtype)
+        out[f[inside], r[inside] - rows[0], c[inside] - cols[0]] = v[inside]
+        return out
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self._view(*self._frames(key))
+        if not isinstance(key, tuple):
+            return self.crop(key, [0, self.frame_shape[0]], [0, self.frame_shape[1]])[0]
+
+        key = key + (slice(None),) * (3 - len(key))
+        bounds = []
+        for k, size in zip(key[1:], self.frame_shape):
+            if not isinstance(k, slice) or k.step not in (None, 1):
+                return np.asarray(self)[key]
+            start, stop, _ = k.indices(size)
+            bounds.append([start, max(start, stop)])
+        out = self.crop(key[0], *bounds)
+        return out if isinstance(key[0], slice) else out[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __array__(self, dtype=None, copy=None):
+        img = self.crop(slice(None), [0, self.frame_shape[0]], [0, self.frame_shape[1]])
+        return img if dtype is None else img.astype(dtype)
+
+    def sum(self, axis=None, dtype=None, out=None, **kwargs):
+        """total (axis=None) or summed image (axis=0); other axes go via the dense stack"""
+        _, r, c, v = self._pixels(0, len(self))
+        if axis is None:
+            return v.sum(dtype=dtype)
+        if axis == 0:
+            ny, nx = self.frame_shape
+            img = np.bincount(r.astype(np.int64) * nx + c, weights=v, minlength=ny * nx)
+            return img.reshape(ny, nx).astype(dtype or np.result_type(v.dtype, int))
+        return np.asarray(self).sum(axis=axis, dtype=dtype)
+
+    def row_sums(self, roix, roiy, shift=None):
+        """
+        (frames, rows) sums along detector x inside the ROI
+        - shift: optional sub-pixel vertical shift of each column in roix,
+          applied as the distortion correction gather map would
+          (rows wrap around the detector height)
+        """
+        ny = self.frame_shape[0]
+        f, r, c, v = self._pixels(0, len(self))
+        inside = (c >= roix[0]) & (c < roix[1])
+        f, r, c, v = f[inside], r[inside].astype(int), c[inside] - roix[0], v[inside]
+        h = roiy[1] - roiy[0]
+        size = len(self) * h
+        if shift is None:
+            contrib = [(r, v)]
+        else:
+            k = np.floor(shift).astype(int)
+            w = shift - k
+            contrib = [((r + k[c]) % ny, v * (1 - w[c])), ((r + k[c] + 1) % ny, v * w[c])]
+        out = np.zeros(size)
+        for ro, vo in contrib:
+            ro = ro - roiy[0]
+            ok = (ro >= 0) & (ro < h)
+            out += np.bincount(f[ok] * h + ro[ok], weights=vo[ok], minlength=size)
+        return out.reshape(len(self), h)
+
+
+def convert_stack(stack, nimg, sparse):
+    """first nimg frames of a dense or sparse stack in the requested storage"""
+    if sparse and not isinstance(stack, SparseStack):
+        return SparseStack.from_dense(stack[:nimg])
+    if not sparse and isinstance(stack, SparseStack):
+        return np.asarray(stack[:nimg])
+    return stack
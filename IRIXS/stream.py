@@ -0,0 +1,94 @@
+""" streaming reduction: frames are reduced as they are decoded, then dropped
+
+In streaming mode the instruments keep only what their reductions need
+(ROI projections, a running total image, the condition accumulator) and
+never hold a run's image stack. Frames that are still wanted afterwards
+(e.g. to step through a run) are read back from disk by a FrameReader.
+"""
+
+import numpy as np
+
+from .sparse import SparseStack
+
+CHUNK = 16  # frames reduced together
+
+
+def chunks(frames, size=CHUNK):
+    """group an iterable of frames into (start, stack) blocks of at most size frames"""
+    block, start = [], 0
+    for i, img in enumerate(frames):
+        if img is None:
+            break
+        block.append(img)
+        if len(block) == size:
+            yield start, np.array(block)
+            block, start = [], i + 1
+    if block:
+        yield start, np.array(block)
+
+
+def add_total(total, img):
+    """
+    add a (frames, ny, nx) block to a running total image
+    - the total is kept as a single-frame SparseStack of its nonzero pixels
+    """
+    tot = np.sum(img, axis=0, dtype=float)
+    if total is not None:
+        tot += total[0]
+    total = SparseStack(tot.shape, tot.dtype)
+    total.append(tot)
+    return total
+
+
+class FrameReader:
+    """
+    read-only stand-in for an image stack whose frames are fetched on demand
+    - load_frame(i) returns the processed frame i (or None)
+    - stack[i] and stack[i, r1:r2, c1:c2] read a single frame,
+      stack[i:j] reads a block of frames
+    """
+
+    def __init__(self, load_frame, n, frame_shape):
+        self.load_frame = load_frame
+        self.n = n
+        self.frame_shape = tuple(frame_shape)
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def shape(self):
+        return (self.n,) + self.frame_shape
+
+    def _frame(self, i):
+        i = int(i)
+        if i < 0:
+            i += self.n
+        if not 0 <= i < self.n:
+            raise IndexError("frame {} out of range".format(i))
+        img = self.load_frame(i)
+        if img is None:
+            raise IndexError("frame {} could not be read".format(i))
+        return img
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            return self[key[0]][(slice(None),) * isinstance(key[0], slice) + key[1:]]
+        if isinstance(key, slice):
+            return np.array([self._frame(i) for i in range(*key.indices(self.n))])
+        return self._frame(key)
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self._frame(i)
+
+    def __array__(self, dtype=None, copy=None):
+        img = self[:]
+        return img if dtype is None else img.astype(dtype)
+
+    def sum(self, axis=None, dtype=None, out=None, **kwargs):
+        """summed image (axis=0) or total, reading one frame at a time"""
+        if axis not in (None, 0):
+            return np.asarray(self).sum(axis=axis, dtype=dtype)
+        tot = sum(np.asarray(img, dtype=dtype or float) for img in self)
+        return tot if axis == 0 else tot.sum()
@@ -1,11 +1,36 @@
 import os
 import numpy as np
 import shutil
+import tempfile
+import threading
 
-from skimage.io import imread
-from tifffile import TiffFileError
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from numpy import sin, cos, sqrt, log, radians, arccos, pi
-from scipy.optimize import curve_fit
+
+
+PLOT_STYLE = {
+    "xtick.top": True,
+    "ytick.right": True,
+    "font.size": 8,
+    "axes.titlesize": "medium",
+    "figure.titlesize": "medium",
+}
+_pyplot = []
+
+
+def pyplot():
+    """
+    matplotlib.pyplot with the IRIXS plot style (PLOT_STYLE)
+    - imported when the first figure is made rather than with the package,
+      so scripted and headless use starts quickly
+    """
+    if not _pyplot:
+        import matplotlib.pyplot as plt
+
+        plt.rcParams.update(PLOT_STYLE)
+        _pyplot.append(plt)
+    return _pyplot[0]
 
 
 def energy_to_wavelength(energy_in_eV):
@@ -75,37 +100,92 @@ def calc_dspacing(hkl, cell):
     return d
 
 
+def bin_edges(n, lo, hi, count):
+    """
+    bin edges used by binning
+    n: bin size
+        - if integer, then divide the count points into steps of n
+        - if float, then n corresponds to step size in eV
+    lo, hi: range of the data
+    """
+    if isinstance(n, int):  # strides (equal bins spanning the range, as np.histogram)
+        if lo == hi:
+            lo, hi = lo - 0.5, hi + 0.5
+        return np.linspace(lo, hi, int(count / n) + 1)
+    return np.arange(lo, hi, n)
+
+
+def bin_init(edges):
+    """empty binning accumulator for the given bin edges"""
+    nbin = len(edges) - 1
+    return {
+        "edges": np.asarray(edges, dtype=float),
+        "sum": np.zeros(nbin),
+        "var": np.zeros(nbin),
+        "count": np.zeros(nbin, dtype=int),
+    }
+
+
+def bin_add(acc, x, y):
+    """
+    add a chunk of points to a binning accumulator
+    - sum, variance and count are reduced with bincount on one shared bin index
+    - bins include their left edge, the last bin also its right edge (as np.histogram)
+    """
+    edges = acc["edges"]
+    nbin = len(edges) - 1
+    x, y = np.asarray(x), np.asarray(y, dtype=float)
+    idx = np.searchsorted(edges, x, side="right") - 1
+    idx[x == edges[-1]] = nbin - 1
+    inside = (idx >= 0) & (idx < nbin)
+    idx, y = idx[inside], y[inside]
+    e = np.sqrt(y)
+    acc["sum"] += np.bincount(idx, weights=y, minlength=nbin)
+    acc["var"] += np.bincount(idx, weights=e * e, minlength=nbin)
+    acc["count"] += np.bincount(idx, minlength=nbin)
+    return acc
+
+
+def bin_result(acc, photon_counting=False):
+    """bin centres, values and errors of a binning accumulator (see binning)"""
+    edges = acc["edges"]
+    yi, ei = acc["sum"].copy(), acc["var"].copy()
+    if not photon_counting:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            yi = yi / acc["count"]
+            ei = np.sqrt(ei) / acc["count"]
+    xi = (edges[1:] + edges[:-1]) / 2
+    return xi, yi, ei
+
+
 def binning(x, y, n, photon_counting=False):
     """
     binning routine that also calculates error
     n: bin size
         - if integer, then simply divide array into steps of n
         - if float, then n corresponds to step size in eV
+        - if array, then n are the bin edges (e.g. shared between runs)
     photon_counting:
         - True: return events per bin
         - False: return intensity per bin averaged by counts
+    points do not need to be sorted; for data arriving in chunks use
+    bin_edges, bin_init, bin_add and bin_result directly
     """
-    e = np.sqrt(y)
-    if isinstance(n, int):  # strides
-        xbin = int(len(x) / n)
-    else:  # regularly spaced (in eV)
-        xbin = np.arange(min(x), max(x), n)
-    yi, xi = np.histogram(x, bins=xbin, weights=y)
-    ei, _ = np.histogram(x, bins=xbin, weights=e ** 2)
-
-    if not photon_counting:
-        count, _ = np.histogram(x, bins=xbin)
-        with np.errstate(divide="ignore", invalid="ignore"):
-            yi = yi / count
-            ei = np.sqrt(ei) / count
-
-    xi = (xi[1:] + xi[:-1]) / 2
-    return xi, yi, ei
+    x = np.asarray(x)
+    if np.ndim(n):
+        edges = n
+    else:
+        edges = bin_edges(n, np.min(x), np.max(x), len(x))
+    acc = bin_add(bin_init(edges), x, y)
+    return bin_result(acc, photon_counting)
 
 
 def peak(x, a, sl, x0, f, bgnd):
-    """basic pseudovoight profile with flat background"""
-    m = np.full(len(x), bgnd)
+    """
+    basic pseudovoight profile with flat background
+    - parameters may be (curves, 1) arrays for x of shape (curves, points)
+    """
+    m = np.full(np.broadcast(x, bgnd).shape, bgnd, dtype=float)
     sg = sl / np.sqrt(2 * log(2))
     m += (
         (1 - f)
@@ -116,29 +196,276 @@ def peak(x, a, sl, x0, f, bgnd):
     return m
 
 
+def peak_jac(x, a, sl, x0, f, bgnd):
+    """
+    analytic derivatives of peak with respect to [a, sl, x0, f, bgnd]
+    returns (..., points, 5), broadcast like peak
+    """
+    c = 1 / np.sqrt(2 * log(2))
+    sg = c * sl
+    d = x - x0
+    d2 = d ** 2
+    l2 = d2 + sl ** 2
+    g1 = np.exp(-d2 / (2 * sg ** 2)) / (sg * np.sqrt(2 * np.pi))
+    l1 = sl / (np.pi * l2)
+    ga, la = (1 - f) * a * g1, f * a * l1
+    jac = [
+        (1 - f) * g1 + f * l1,
+        ga * (d2 / sg ** 3 - 1 / sg) * c + f * a / np.pi * (d2 - sl ** 2) / l2 ** 2,
+        ga * d / sg ** 2 + la * 2 * d / l2,
+        a * (l1 - g1),
+        np.ones_like(d2),
+    ]
+    return np.stack(np.broadcast_arrays(*jac), axis=-1)
+
+
+PEAK_BOUNDS = [(0, 1e-6, -1e9, 0, 0), (1e9, 1e6, 1e9, 1, 1e9)]
+THETA = 0.99  # fraction of the way to a bound taken by a step across it
+
+
+def peak_guess(x, y):
+    """
+    initial [amp, sig, cen, fra, bgnd] of peak fits from the curve maximum
+    and the point nearest half height, for one curve or (curves, points)
+    arrays (NaN points are ignored)
+    """
+    x = np.broadcast_to(x, np.shape(y))
+    bgnd = np.nanmin(y, axis=-1)
+    ymax = np.nanmax(y, axis=-1)
+    height = ymax - bgnd
+    dev = np.abs(y - (height / 2 - bgnd)[..., None])
+    half = np.take_along_axis(x, np.nanargmin(dev, axis=-1)[..., None], -1)[..., 0]
+    dev = np.abs(y - ymax[..., None])
+    cen = np.take_along_axis(x, np.nanargmin(dev, axis=-1)[..., None], -1)[..., 0]
+    sig = np.abs(half - cen) * 2 / 2
+    amp = height * (sig * np.sqrt(2.0 * np.pi))
+    return np.stack(np.broadcast_arrays(amp, sig, cen, 0.5, bgnd), axis=-1)
+
+
+def peak_curve(x, p, points=1000):
+    """fitted peak p evaluated on points evenly spaced over the range of x"""
+    xf = np.linspace(np.min(x), np.max(x), points)
+    return xf, peak(xf, *p)
+
+
 def peak_fit(x, y):
     """
     peak fit routine that guesses initial values
     returns fitted peak xf,yf and parameters p = [amp, sig, cen, fra, bgnd]
     """
-    fra = 0.5
-    bgnd = float(np.min(y))
-    height = np.max(y) - bgnd
-    half = x[np.abs(y - height / 2 + bgnd).argmin()]
-    cen = x[np.abs(y - np.max(y)).argmin()]
-    fwhm = np.abs(half - cen) * 2
-    sig = fwhm / 2
-    amp = height * (sig * np.sqrt(2.0 * np.pi))
+    p0 = peak_guess(x, y)
+    from scipy.optimize import curve_fit
 
-    xf = np.linspace(x.min(), x.max(), 1000)
-    p0 = [amp, sig, cen, fra, bgnd]
-    bounds = [(0, 1e-6, -1e9, 0, 0), (1e9, 1e6, 1e9, 1, 1e9)]
-    p, _ = curve_fit(peak, x, y, p0, bounds=bounds)
-    yi = peak(xf, *p)
+    p, _ = curve_fit(peak, x, y, p0, bounds=PEAK_BOUNDS, jac=peak_jac)
+    xf, yi = peak_curve(x, p)
 
     return xf, yi, p
 
 
+def _pad(curves):
+    # list of 1d curves of any length -> (curves, points) array, NaN padded
+    n = max((len(c) for c in curves), default=0)
+    out = np.full((len(curves), n), np.nan)
+    for i, c in enumerate(curves):
+        out[i, : len(c)] = c
+    return out
+
+
+def peak_fit_batch(x, y, max_iter=100, tol=1e-8):
+    """
+    fit peak to many curves at once, from the initial values of peak_fit
+    -- x, y : (curves, points) arrays, or lists of 1d curves (x may be a
+       single 1d array shared by all curves), NaN points are ignored
+    -- max_iter : Levenberg-Marquardt steps taken on all curves together,
+       curves not converged by then are fitted one by one with curve_fit
+    -- tol : relative change of the cost or of all parameters at convergence
+    returns parameters (curves, 5) = [amp, sig, cen, fra, bgnd], NaN where
+    the fit failed or the initial guess is out of bounds (zero width), as
+    peak_fit would
+    - fitted curves are not evaluated, see peak_curve
+    """
+    y = _pad(y) if isinstance(y, list) else np.asarray(y, dtype=float)
+    x = _pad(x) if isinstance(x, list) else np.asarray(x, dtype=float)
+    x = np.broadcast_to(x, y.shape)
+    valid = np.isfinite(x) & np.isfinite(y)
+    x, y = np.where(valid, x, 0), np.where(valid, y, np.nan)
+
+    lo, hi = np.array(PEAK_BOUNDS)
+    out = np.full((len(y), 5), np.nan)
+    todo = valid.any(axis=1)
+    p = np.full((len(y), 5), np.nan)
+    if todo.any():
+        p[todo] = peak_guess(x[todo], y[todo])
+    todo &= np.all((p >= lo) & (p <= hi), axis=1)
+    p0 = p
+    y = np.where(valid, y, 0)
+
+    def residual(i, p):
+        return (peak(x[i], *p.T[..., None]) - y[i]) * valid[i]
+
+    idx = np.flatnonzero(todo)
+    p = p[idx]
+    r = residual(idx, p)
+    cost = np.sum(r ** 2, axis=1)
+    lam = np.ones(len(idx))
+    rest = []  # left to curve_fit
+    for _ in range(max_iter):
+        jac = peak_jac(x[idx], *p.T[..., None]) * valid[idx][..., None]
+        jtj = np.einsum("cpi,cpj->cij", jac, jac)
+        grad = np.einsum("cpi,cp->ci", jac, r)
+        ok = np.isfinite(jtj).all(axis=(1, 2)) & np.isfinite(grad).all(axis=1)
+        if not ok.all():  # e.g. overflow at a vanishing width
+            rest.extend(idx[~ok])
+            idx, p, r, cost, lam = idx[ok], p[ok], r[ok], cost[ok], lam[ok]
+            jtj, grad = jtj[ok], grad[ok]
+        if not len(idx):
+            break
+        diag = np.diagonal(jtj, axis1=1, axis2=2)
+        diag = np.maximum(diag, 1e-12 * (1 + diag.max(axis=1, keepdims=True)))
+        damped = jtj + (lam[:, None] * diag)[..., None] * np.eye(5)
+
+        def solve(held, fixed=0):
+            # held parameters take the fixed step, the others the best given them
+            fixed = np.where(held, fixed, 0)
+            free = ~held[:, :, None] & ~held[:, None, :]
+            rhs = -grad - np.einsum("cij,cj->ci", damped, fixed)
+            rhs = np.where(held, fixed, rhs)[..., None]
+            return np.linalg.solve(np.where(free, damped, np.eye(5)), rhs)[..., 0]
+
+        def towards_bounds(pn):
+            # a step across a bound goes most of the way, onto it once close
+            pn = np.clip(pn, p + THETA * (lo - p), p + THETA * (hi - p))
+            return np.where(np.minimum(pn - lo, hi - pn) < 1e-6, np.clip(pn, lo, hi), pn)
+
+        # parameters at a bound the descent pushes against are held there
+        held = ((p <= lo) & (grad > 0)) | ((p >= hi) & (grad < 0))
+        pn = p + solve(held)
+        crossing = (pn < lo) | (pn > hi)
+        limited = crossing & (towards_bounds(pn) != p)
+        if crossing.any():
+            pn = towards_bounds(p + solve(held | crossing, towards_bounds(pn) - p))
+        rn = residual(idx, pn)
+        costn = np.sum(rn ** 2, axis=1)
+
+        better = costn < cost
+        done = better & (cost - costn <= tol * cost) & ~limited.any(axis=1)
+        done |= np.all(np.abs(pn - p) <= tol * (tol + np.abs(p)), axis=1)
+        p[better], r[better], cost[better] = pn[better], rn[better], costn[better]
+        lam = np.where(better, np.maximum(lam / 10, 1e-10), lam * 10)
+        done |= lam > 1e10  # no step lowers the cost any more
+        done &= np.isfinite(cost)
+
+        out[idx[done]] = p[done]
+        keep = ~done
+        idx, p, r, cost, lam = idx[keep], p[keep], r[keep], cost[keep], lam[keep]
+
+    rest.extend(idx)
+    if rest:
+        from scipy.optimize import curve_fit
+
+        for i in rest:
+            v = valid[i]
+            try:
+                out[i], _ = curve_fit(
+                    peak, x[i, v], y[i, v], p0[i], bounds=PEAK_BOUNDS, jac=peak_jac
+                )
+            except (RuntimeError, ValueError):
+                pass
+
+    return out
+
+
+def read_fio_data(f):
+    """
+    read the data block of an open .fio file (positioned anywhere before the
+    'Col' lines) - returns column names, structured data array (or None) and
+    whether the scan was completed ('! Acquisition ended')
+    - numbers are converted in bulk rather than line by line
+    - a last line without newline is kept if it is a comment, or a data row
+      of a completed scan; while the file is still being written it may be
+      cut anywhere (even mid-number) and is dropped
+    """
+    text = f.read()
+    lines = text.split("\n")
+    last = lines.pop()  # either empty, a finished last line or still being written
+    if last.startswith("!"):
+        lines.append(last)
+        last = ""
+
+    head = []
+    i = 0
+    for i, line in enumerate(lines):
+        l = line.split()
+        if l and l[0] == "Col":
+            head.append(l[2])
+        elif head:
+            break
+    else:
+        i = len(lines)
+    if not head:
+        return head, None, False
+
+    end = i
+    while end < len(lines) and lines[end].strip() and lines[end][0] != "!":
+        end += 1
+    complete = any(l.startswith("! Acquisition ended") for l in lines[end:])
+    rows = lines[i:end]
+    ncol = len(head)
+    if complete and end == len(lines) and len(last.split()) == ncol:
+        try:
+            [float(x) for x in last.split()]
+            rows.append(last)
+        except ValueError:
+            pass
+    if not rows:
+        return head, None, complete
+
+    try:
+        data = np.loadtxt(rows, dtype=float, ndmin=2)
+        if data.shape[1] != ncol:
+            raise ValueError
+    except ValueError:  # odd lines: keep the ones that parse completely
+        data = []
+        for row in rows:
+            try:
+                r = [float(x) for x in row.split()]
+            except ValueError:
+                continue
+            if len(r) == ncol:
+                data.append(r)
+        data = np.array(data, dtype=float).reshape(-1, ncol)
+    if not len(data):
+        return head, None, complete
+
+    data = np.ascontiguousarray(data).view(dtype=[(n, float) for n in head])
+    return head, data.reshape(len(data)), complete
+
+
+_io = {"count": False, "bytes": 0, "lock": threading.Lock()}
+
+
+def io_counting(on=True):
+    """count the bytes of .fio, .tiff and stack cache files read (see profiling.py)"""
+    _io["count"] = on
+
+
+def bytes_read():
+    """bytes read since counting was switched on"""
+    return _io["bytes"]
+
+
+def count_read(path=None, fd=None):
+    """add the size of a file read (by path or open file descriptor) when counting"""
+    if not _io["count"]:
+        return
+    try:
+        size = os.fstat(fd).st_size if fd is not None else os.path.getsize(path)
+    except OSError:
+        return
+    with _io["lock"]:
+        _io["bytes"] += size
+
+
 def load_fio(run, exp, datdir):
     """
     .fio loader - returns everything as a dict
@@ -147,15 +474,13 @@ def load_fio(run, exp, datdir):
     looks for '! Acquisition ended' to see if scan has been completed
     """
     a = {}
-    head = []
-    data = []
-    complete = False
     fio_file = "{0}_{1:05d}.fio".format(exp, run)
     path = os.path.join(datdir, fio_file)
     if not os.path.isfile(path):
         print("#{0:<4} -- no .fio".format(run))
         return
     with open(path) as f:
+        count_read(fd=f.fileno())
         for line in f:
             l = line.strip()
             if l.startswith("%c"):
@@ -172,26 +497,10 @@ def load_fio(run, exp, datdir):
                     a[p.strip()] = float(v)
                 except TypeError:
                     a[p.strip()] = v.strip()
-        for line in f:
-            l = line.strip().split()
-            if not l:
-                break
-            if l[0] == "Col":
-                head.append(l[2])
-            else:
-                try:
-                    data.append([float(x) for x in l])
-                except ValueError:
-                    if line.startswith("! Acquisition ended"):
-                        complete = True
-    if head and data:
-
-        data = [x for x in data if x]
-        data = np.array(data)
-        pnts = data.shape[0]
-        data = data.view(dtype=[(n, float) for n in head])
-        data = data.reshape(len(data))
+        head, data, complete = read_fio_data(f)
+    if head and data is not None:
 
+        pnts = data.shape[0]
         a["data"] = data
         a["auto"] = head[0]
         a["pnts"] = pnts
@@ -222,22 +531,128 @@ def load_fio(run, exp, datdir):
         return a
 
 
+BIAS_SAMPLES = 65536  # pixels per quadrant used to estimate its bias
+
+
 def bias_correct_4output(rawimg):
     """
     correct bias of the Four DAC output mode of the greateyes detector ("EFGH")
-    divide matrix up into four quadrants and subtract median from each quadrant
-    """
-    r, h = rawimg.shape[1], rawimg.shape[0]
-    nrows,ncols = h//2, r//2
-    img = (rawimg
-           .reshape((h//nrows,nrows,-1,ncols))
-           .swapaxes(1,2)
-           .reshape((-1, nrows, ncols)))
-    for i,im in enumerate(img):
-        cen = int(np.median(im))
-        img[i] -= cen
-    img = np.block([[img[0], img[1]], [img[2], img[3]]])
-    return img
+    subtract the median of each of the four quadrants, in place
+    - rawimg is a frame or a (frames, rows, cols) stack, every frame of a
+      stack is corrected at once
+    - the median is taken over an evenly subsampled grid of about
+      BIAS_SAMPLES pixels of the quadrant
+    """
+    stack = rawimg if rawimg.ndim == 3 else rawimg[None]
+    nrows, ncols = stack.shape[1] // 2, stack.shape[2] // 2
+    step = max(1, int(np.sqrt(nrows * ncols / BIAS_SAMPLES)))
+    for rows in [slice(0, nrows), slice(nrows, 2 * nrows)]:
+        for cols in [slice(0, ncols), slice(ncols, 2 * ncols)]:
+            q = stack[:, rows, cols]
+            sample = q[:, ::step, ::step].reshape(len(q), -1)
+            cen = np.median(sample, axis=1).astype(int)
+            np.subtract(q, cen[:, None, None], out=q, casting="unsafe")
+    return rawimg
+
+
+_mirror = {
+    "pool": None,
+    "pending": deque(),
+    "lock": threading.Lock(),
+    "held": threading.local(),  # copies held back in a map_frames thread
+}
+MIRROR_PENDING = 64  # local copies allowed to queue before load_tiff waits
+
+
+def _reset_mirror():
+    # a forked child (e.g. a batch worker) inherits the pool but not its thread
+    _mirror["pool"], _mirror["pending"] = None, deque()
+    _mirror["lock"] = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_mirror)
+
+
+def _copy_local(src, path):
+    """
+    copy an open remote file to path: written to a temporary name, checked
+    against the source size and only then moved into place, so a local copy
+    is either complete or absent
+    """
+    folder = os.path.dirname(path)
+    tmp = None
+    with src:
+        try:
+            size = os.fstat(src.fileno()).st_size
+            os.makedirs(folder, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(suffix=".part", dir=folder)
+            with os.fdopen(fd, "wb") as f:
+                try:  # in-kernel copy, the data was just read and is cached
+                    offset = 0
+                    while offset < size:
+                        sent = os.sendfile(f.fileno(), src.fileno(), offset, size - offset)
+                        if not sent:
+                            break
+                        offset += sent
+                except (AttributeError, OSError):
+                    src.seek(0)
+                    f.seek(0)
+                    f.truncate()
+                    shutil.copyfileobj(src, f)
+            if os.path.getsize(tmp) == size:
+                os.replace(tmp, path)
+                tmp = None
+        except OSError:
+            pass
+        finally:
+            if tmp:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+
+
+def mirror_file(src, path):
+    """
+    queue a local copy of an open (already decoded) remote file
+    - inside map_frames the copy is held back and queued once the frame is
+      yielded, so copies are made in scan order
+    """
+    held = getattr(_mirror["held"], "copies", None)
+    if held is not None:
+        held.append((src, path))
+        return
+    with _mirror["lock"]:
+        if _mirror["pool"] is None:
+            _mirror["pool"] = ThreadPoolExecutor(1)
+        pending = _mirror["pending"]
+        while pending and (pending[0].done() or len(pending) >= MIRROR_PENDING):
+            pending.popleft().result()
+        pending.append(_mirror["pool"].submit(_copy_local, src, path))
+
+
+def flush_mirror():
+    """wait until all queued local copies are written"""
+    with _mirror["lock"]:
+        pool = _mirror["pool"]
+        if pool is None:
+            return
+        # copies run in order on a single thread: once this no-op ran, all earlier ones did
+        done = pool.submit(int)
+    done.result()
+
+
+def tiff_index(path):
+    """
+    frame number of a tiff ("<exp>_<run>_<frame>.tiff"), the scan order of
+    local copies (their creation time is the order they were copied in)
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    try:
+        return int(stem.rsplit("_", 1)[-1])
+    except ValueError:
+        return -1
 
 
 def load_tiff(
@@ -252,10 +667,16 @@ def load_tiff(
     """
     loads a tiff image and returns as a numpy array
     - if localdir defined, looks to local directory first,
-      otherwise copies the remote file once loaded
-    - catches corrupted tiff files from previous copy operation cancellation
+      otherwise the remote file is opened once, decoded, and the same open
+      file copied to local in the background (see mirror_file)
+    - local copies only appear once complete, an unreadable one (e.g. left
+      by an older interrupted copy) is replaced from the remote file
     """
 
+    # image i/o is imported on first use, not with the package
+    import tifffile
+    from skimage.io import imread
+
     # generate tiff filename from step number if given
     if isinstance(tiff, int):
         tiff = "{0}_{1:05d}_{2:04d}.tiff".format(exp, run, tiff)
@@ -269,19 +690,31 @@ def load_tiff(
             img = imread(path_local)
             # check if tiff file was corrupted on previous copy to local
             if img.shape[0] == 0:
-                raise TiffFileError
-        except (OSError, TiffFileError):
+                img = None
+            else:
+                count_read(path_local)
+        except (OSError, ValueError):
+            img = None
+        if img is None:
             try:
-                os.makedirs(os.path.dirname(path_local), exist_ok=True)
-                shutil.copyfile(path_remote, path_local)
-                img = imread(path_local)
+                src = open(path_remote, "rb")
             except OSError:
                 return
+            try:
+                img = tifffile.imread(src)
+                if img.shape[0] == 0:
+                    raise ValueError
+            except (OSError, ValueError):  # still being written: no local copy
+                src.close()
+                return
+            count_read(fd=src.fileno())
+            mirror_file(src, path_local)
     else:
         try:
             img = imread(path_remote)
         except OSError:
             return
+        count_read(path_remote)
 
     if bias_correct:
         img = bias_correct_4output(img)
@@ -289,6 +722,70 @@ def load_tiff(
     return img
 
 
+def map_frames(func, items, workers=1):
+    """
+    apply func (typically load + threshold of one frame) to each item
+    - with workers > 1 frames are fetched and decoded concurrently in a
+      thread pool, results are still yielded in the original order
+    - at most 2 * workers frames are held in flight
+    - local copies of remote frames (see mirror_file) are queued as each
+      frame is yielded, in order
+    """
+    if workers is None or workers <= 1:
+        yield from map(func, items)
+        return
+
+    def call(item):
+        _mirror["held"].copies = copies = []
+        try:
+            return func(item), copies
+        finally:
+            _mirror["held"].copies = None
+
+    def result(future):
+        img, copies = future.result()
+        for src, path in copies:  # local copies in scan order
+            mirror_file(src, path)
+        return img
+
+    def drop(future):
+        if not future.cancelled() and future.exception() is None:
+            for src, _ in future.result()[1]:
+                src.close()
+
+    with ThreadPoolExecutor(workers) as pool:
+        pending = deque()
+        try:
+            for item in items:
+                pending.append(pool.submit(call, item))
+                if len(pending) > 2 * workers:
+                    yield result(pending.popleft())
+            while pending:
+                yield result(pending.popleft())
+        finally:
+            for f in pending:  # caller stopped early: no copies of unused frames
+                f.cancel()
+                f.add_done_callback(drop)
+
+
+def alloc_stack(pnts, frame):
+    """preallocate a contiguous (pnts, ny, nx) image stack matching frame"""
+    return np.zeros((pnts,) + frame.shape, dtype=frame.dtype)
+
+
+def grow_stack(stack, pnts):
+    """
+    make room for at least pnts frames in a preallocated image stack
+    - frames already stored are kept
+    - capacity is at least doubled so that repeated growth stays cheap
+    """
+    if pnts <= len(stack):
+        return stack
+    grown = np.zeros((max(pnts, 2 * len(stack)),) + stack.shape[1:], stack.dtype)
+    grown[: len(stack)] = stack
+    return grown
+
+
 def flatten(*n):
     """flattens a lists of lists/ranges/tuples for loading"""
     return [
@@ -34,7 +34,6 @@ import numpy as np
 
 from numpy import pi, sin, cos, radians, degrees
 from numpy.linalg import norm, inv, multi_dot
-from scipy.optimize import least_squares
 from copy import deepcopy
 
 from .tools import reciprocol_lattice, energy_to_wavelength
@@ -274,6 +273,8 @@ class sixc:
             hkl = q_hkl(self._wl, self._UB, angles[0], angles[1], angles[2])
             return hkl[0]-h, hkl[1]-k, hkl[2]-l
 
+        from scipy.optimize import least_squares
+
         result = least_squares(fitfun, x0, args=(h, k, l))
         th_tth_chi = np.array(result.x)
 
@@ -294,6 +295,8 @@ class sixc:
 
         x0 = [pi/4, self._orientation[2][2]]  # init with th=45, chi=chi0
 
+        from scipy.optimize import least_squares
+
         angle_list = []
         for hk in hk_list:
             result = least_squares(fitfun, x0, args=hk)
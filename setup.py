@@ -26,7 +26,10 @@ setup(
     entry_points={
         'console_scripts': [
             'p01plot=IRIXS.p01plot:main',
-            'irixs_oneshot=IRIXS.oneshot:main'],
+            'irixs_oneshot=IRIXS.oneshot:main',
+            'irixs_mirror=IRIXS.mirror:main',
+            'irixs_reduce=IRIXS.reduce:main',
+            'irixs_benchmark=IRIXS.benchmark:main'],
     },
     classifiers=[
         'Development Status :: 4 - Beta',
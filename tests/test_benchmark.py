@@ -0,0 +1,35 @@
+""" performance regression tests: the irixs_benchmark cases held to their budgets
+
+The cases run on the default synthetic experiment (see IRIXS/benchmark.py).
+Times are checked relative to decoding the same tiffs in this process and
+memory as peak RSS per MB of image data, so the budgets do not depend on
+the speed of the machine running the tests.
+"""
+
+import os
+
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+import pytest
+
+from IRIXS.benchmark import CASES, BUDGETS, run_benchmarks, check
+
+
+@pytest.fixture(scope="module")
+def results(tmp_path_factory):
+    root = tmp_path_factory.mktemp("irixs_benchmark")
+    return {r["case"]: r for r in run_benchmarks(str(root), repeat=3)}
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_within_budget(results, case):
+    assert not check([results[case]])
+
+
+def test_every_case_has_a_budget():
+    assert set(BUDGETS) == set(CASES)
+
+
+def test_check_flags_a_slow_case():
+    r = {"case": "load", "relative": 100.0, "peak MB": 1.0, "data MB": 10.0}
+    assert check([r]) == ["load: time 100.00 > {}".format(BUDGETS["load"]["time"])]